@@ -1,7 +1,9 @@
 __all__ = (
-    'devnull'
+    'asyncsqlitedb'
+    ,'devnull'
     ,'dorunrun'
     ,'fifo'
+    ,'fifodispatcher'
     ,'fname'
     ,'gdecorators'
     ,'glinux'
@@ -10,9 +12,13 @@ __all__ = (
     ,'gpath'
     ,'grandom'
     ,'gtime'
+    ,'ipcbench'
     ,'oracleutils'
+    ,'shardedsqlitedb'
+    ,'shmring'
     ,'slop'
     ,'sqlitedb'
     ,'stopwatch'
     ,'tombstone'
+    ,'writefunnel'
     )
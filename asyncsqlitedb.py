@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+An asyncio facade for SQLiteDB.
+
+Coroutines must not call SQLiteDB.execute_SQL directly, because every
+disk wait blocks the event loop. AsyncSQLiteDB moves the work off the
+loop:
+
+    writes -- go through a queue to one dedicated writer thread. The
+        writer takes everything that is waiting, and applies it in one
+        transaction, each statement inside its own savepoint so that
+        one bad statement does not spoil the others.
+
+    reads  -- run on a small thread pool, each read borrowing one of a
+        pool of read-only connections.
+
+Usage:
+
+    from asyncsqlitedb import AsyncSQLiteDB
+
+    async with AsyncSQLiteDB('my.db') as db:
+        rows = await db.execute('SELECT * FROM t WHERE a = ?', 1)
+        n = await db.execute('UPDATE t SET b = ? WHERE a = ?', 'x', 1)
+        n = await db.bulk_write('INSERT INTO t VALUES (?, ?)', rows)
+        async for row in db.fetch_stream('SELECT * FROM big'):
+            ...
+"""
+
+import typing
+from   typing import *
+
+import asyncio
+import concurrent.futures
+import os
+import queue
+import sqlite3
+import threading
+
+from   sqlitedb import SQLiteDB, StatementRegistry
+from   tombstone import tombstone
+
+# Credits
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2020'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'me@georgeflanagin.com'
+__status__ = 'Prototype'
+
+__license__ = 'MIT'
+
+
+def settle(future:asyncio.Future, result:object, e:Exception) -> None:
+    """
+    Called on the event loop to deliver what the writer thread found.
+    The awaiting coroutine may have given up in the meantime.
+    """
+    if future.cancelled(): return
+    if e is not None:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+class AsyncSQLiteDB:
+    """
+    Awaitable execute, fetch_stream, and bulk_write on an SQLite
+    database, without blocking the event loop.
+    """
+
+    def __init__(self, path_to_db:str, *,
+        readers:int=4,
+        max_batch:int=1000,
+        wal:bool=True,
+        **kwargs):
+        """
+        path_to_db -- as for SQLiteDB; the database must exist.
+        readers    -- the number of read-only connections (and threads).
+        max_batch  -- the most writes to coalesce into one transaction.
+        wal        -- put the database in WAL mode so that readers and
+            the writer do not block each other.
+        kwargs     -- passed along to the writer's SQLiteDB.
+        """
+        if not os.path.isfile(path_to_db):
+            raise Exception(f"No database named {path_to_db} found.")
+
+        self.name = path_to_db
+        self.max_batch = max_batch
+        self.statements = StatementRegistry(kwargs.get('cached_statements', 256))
+        self.writes = queue.Queue()
+        self.transactions = 0
+        self.coalesced = 0
+        self.startup_error = None
+
+        # The writer opens its own connection; sqlite3 connections
+        # belong to the thread that created them.
+        ready = threading.Event()
+        self.writer = threading.Thread(target=self._writer,
+            args=(kwargs, wal, ready), name=f"writer:{path_to_db}", daemon=True)
+        self.writer.start()
+        ready.wait()
+        if self.startup_error is not None:
+            raise Exception(f"cannot open {path_to_db} for writing: {self.startup_error}")
+
+        # Connections are handed out on the event loop, guarded by the
+        # semaphore, so that no reader thread ever waits for one while
+        # the holder of a connection waits for a thread.
+        self.connections = queue.Queue()
+        for i in range(readers):
+            self.connections.put(sqlite3.connect(f"file:{path_to_db}?mode=ro",
+                uri=True, check_same_thread=False))
+        self.available = asyncio.Semaphore(readers)
+        self.readers = concurrent.futures.ThreadPoolExecutor(readers,
+            thread_name_prefix=f"reader:{path_to_db}")
+
+
+    async def __aenter__(self) -> 'AsyncSQLiteDB':
+        return self
+
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+
+    def __str__(self) -> str:
+        return self.name
+
+
+    ###
+    # The writer thread.
+    ###
+
+    def _writer(self, kwargs:dict, wal:bool, ready:threading.Event) -> None:
+        """
+        Apply the writes as they arrive. Each item on the queue is
+
+            (SQL, args, many, future, loop)
+
+        and None is the signal to stop.
+        """
+        kwargs['isolation_level'] = None
+        kwargs['use_pandas'] = False
+        try:
+            db = SQLiteDB(self.name, **kwargs)
+            if wal: db.cursor.execute('pragma journal_mode = WAL').fetchall()
+        except Exception as e:
+            self.startup_error = e
+            return
+        finally:
+            ready.set()
+
+        running = True
+        while running:
+            batch = [self.writes.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty as e:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [ _ for _ in batch if _ is not None ]
+            if not batch: continue
+
+            results = []
+            try:
+                db.cursor.execute('BEGIN IMMEDIATE')
+                for SQL, args, many, future, loop in batch:
+                    db.cursor.execute('SAVEPOINT write')
+                    try:
+                        if many:
+                            cursor = db.cursor.executemany(SQL, args)
+                        else:
+                            cursor = db.cursor.execute(SQL, args)
+                        results.append((cursor.rowcount, None))
+                        db.cursor.execute('RELEASE write')
+
+                    except Exception as e:
+                        # Not only sqlite3.Error: a generator given to
+                        # bulk_write may raise anything, and bad args
+                        # raise TypeError or ValueError.
+                        db.cursor.execute('ROLLBACK TO write')
+                        db.cursor.execute('RELEASE write')
+                        results.append((None, e))
+
+                db.cursor.execute('COMMIT')
+                self.transactions += 1
+                self.coalesced += len(batch)
+
+            except Exception as e:
+                tombstone(f"transaction of {len(batch)} writes failed: {e}")
+                try:
+                    if db.db.in_transaction: db.cursor.execute('ROLLBACK')
+                except Exception as e_:
+                    tombstone(f"rollback failed: {e_}")
+                results = [ (None, e) ] * len(batch)
+
+            for (SQL, args, many, future, loop), (result, e) in zip(batch, results):
+                loop.call_soon_threadsafe(settle, future, result, e)
+
+        db.db.close()
+
+
+    def _write(self, SQL:str, args:object, many:bool) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.writes.put((SQL, args, many, future, loop))
+        return future
+
+
+    ###
+    # The readers.
+    ###
+
+    def _read(self, db:sqlite3.Connection, SQL:str, args:tuple) -> list:
+        return db.execute(SQL, args).fetchall()
+
+
+    ###
+    # The public interface.
+    ###
+
+    async def execute(self, SQL:str, *args) -> Union[list, int]:
+        """
+        Run one statement. Parameters may be given one by one, or
+        as a single tuple.
+
+        returns -- the rows for statements that read, and the
+            number of rows affected for those that write.
+        """
+        if len(args) == 1 and isinstance(args[0], (tuple, list)):
+            args = tuple(args[0])
+
+        if self.statements(SQL).is_read:
+            async with self.available:
+                db = self.connections.get_nowait()
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(
+                        self.readers, self._read, db, SQL, args)
+                finally:
+                    self.connections.put(db)
+
+        return await self._write(SQL, args, False)
+
+
+    async def bulk_write(self, SQL:str, rows:Iterable[tuple]) -> int:
+        """
+        executemany, in the writer thread. The rows are consumed in
+        the writer thread, so a generator is fine.
+
+        returns -- the number of rows affected.
+        """
+        return await self._write(SQL, rows, True)
+
+
+    async def fetch_stream(self, SQL:str, *args,
+        chunk:int=1000) -> AsyncIterator[tuple]:
+        """
+        Iterate over the rows of a SELECT without holding them all in
+        memory. A read-only connection is held for the life of the
+        iteration, and rows are fetched chunk at a time on the pool.
+        """
+        if len(args) == 1 and isinstance(args[0], (tuple, list)):
+            args = tuple(args[0])
+
+        loop = asyncio.get_running_loop()
+        async with self.available:
+            db = self.connections.get_nowait()
+            cursor = db.cursor()
+            try:
+                await loop.run_in_executor(self.readers, cursor.execute, SQL, args)
+                while True:
+                    rows = await loop.run_in_executor(self.readers, cursor.fetchmany, chunk)
+                    if not rows: break
+                    for row in rows: yield row
+
+            finally:
+                cursor.close()
+                self.connections.put(db)
+
+
+    async def close(self) -> None:
+        """
+        Let the writer finish what is queued, and release everything.
+        """
+        if not self.writer.is_alive(): return
+        self.writes.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.join)
+        self.readers.shutdown()
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
@@ -31,6 +31,45 @@ Usage:
     data are read out in situ, otherwise the read operation
     returns a list of things found, even if it is a list with only
     one element.
+
+    Framing. By default, each read is a single os.read of at most
+    1024 bytes, so long messages are cut short, and a message may 
+    be split between two reads. If the pipe is opened with
+
+        framing='length'    -- each message is preceded by its length
+            as a four byte, big-endian integer.
+        framing='delimiter' -- each message is followed by the 
+            delimiter, including the last one.
+
+    then a read drains the pipe with large reads, keeps any partial 
+    message until the rest of it arrives, and returns every complete
+    message. The reader and the writers must use the same framing.
+
+    Binary. With binary=True, messages are bytes-like objects (bytes,
+    bytearray, memoryview, or anything with the buffer protocol, such
+    as a NumPy array), always length framed, and never encoded. Writes
+    hand the headers and payloads to os.writev without joining them,
+    and reads use os.readv into one preallocated, reusable bytearray.
+    splice_to() moves raw pipe data to a file with os.splice, without 
+    copying it through user space at all.
+
+    Backpressure. By default, a writer that finds the pipe full logs
+    the error and drops the message. Given a queue_size, the writer 
+    keeps an outbound queue instead, and send() (or write()) puts each
+    message on it and writes what the pipe will take. When the queue
+    is full, the policy decides: 'block' waits for the reader, 
+    'drop_oldest' discards the oldest unsent message, and 'error' 
+    raises FIFOFull. Partial writes are resumed where they left off,
+    and messages no larger than PIPE_BUF are written whole, several at
+    a time where they fit, so that they are never torn by other writers.
+    pipe_size asks the kernel for a larger pipe (F_SETPIPE_SZ).
+
+    Shared memory. With transport='shm', the messages go through a 
+    ShmRing (see shmring.py) that the reader creates and one writer
+    attaches to, and the pipe is only a doorbell. The writer copies each
+    message into the ring, and writes a byte to the pipe only if the 
+    reader has said it is going to sleep. Reads and writes are the same
+    calls as before. A full ring drops the write, as a full pipe does.
 """
 
 import typing
@@ -47,18 +86,39 @@ __required_version__ = (3, 6)
 
 __license__ = 'MIT'
 
+import asyncio
+import collections
+import fcntl
+import hashlib
 import os
 import select
 import stat
+import itertools
+import struct
 import sys
+import time
 
 if sys.version_info < __required_version__:
     print(f"This code requires Python version {__required_version__} or later.")
     sys.exit(os.EX_SOFTWARE)
 
 from   gdecorators import trap
+from   shmring import ShmRing
 from   tombstone import tombstone
 
+# Not every version of the fcntl module has names for these.
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+
+
+class FIFOFull(Exception):
+    """
+    Raised by FIFO.send() when the outbound queue is full and the 
+    policy is 'error'.
+    """
+    pass
+
+
 class FIFO:
     """
     Wrapper around the internals of pipe based IPC.
@@ -73,12 +133,36 @@ class FIFO:
         "w": os.O_WRONLY | os.O_NONBLOCK
         }
 
+    framings = ( None, 'length', 'delimiter' )
+
+    policies = ( 'block', 'drop_oldest', 'error' )
+
+    transports = ( 'pipe', 'shm' )
+
+    # With transport='shm', a sleeping reader looks at the ring this 
+    # often, in case the doorbell rang before it said it was idle.
+    doorbell_slice = 0.01
+
+    # The size of the reads used to drain the pipe in the framed modes.
+    read_size = 65536
+
+    # The most buffers one call to os.writev will take.
+    iov_max = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+
 
     def __init__(self, 
             pipe_name:str, 
             mode:str='non_block', 
             delimiter:str='',
-            ignore:str=""):
+            ignore:str="",
+            framing:str=None,
+            binary:bool=False,
+            buffer_size:int=1<<20,
+            queue_size:int=0,
+            policy:str='block',
+            pipe_size:int=None,
+            transport:str='pipe',
+            ring_size:int=1<<22):
         """
         Safely open a new or existing FIFO for reading
         or writing. Note that if the function returns, it
@@ -94,6 +178,16 @@ class FIFO:
         ignore -- to facilitate testing, messages that begin like this
             will be discarded up through the next delimiter or the
             end of the message.
+        framing -- None, 'length', or 'delimiter'. See above.
+        binary -- if True, messages are bytes, and the framing is 'length'.
+        buffer_size -- the initial size of the binary read buffer. It 
+            grows if a single message is larger.
+        queue_size -- the most messages a writer will hold while the pipe
+            is full. Zero means no queue.
+        policy -- what to do when the queue is full. See above.
+        pipe_size -- if given, the capacity to ask for, in bytes.
+        transport -- 'pipe', or 'shm' for a shared memory ring.
+        ring_size -- the capacity of the ring, set by the reader.
         """
     
         self.fifo = None
@@ -103,6 +197,25 @@ class FIFO:
         self.mode = mode
         self.delimiter = "" if delimiter is None else delimiter
         self.ignore = "#" if ignore is None else ignore
+        self.framing = 'length' if binary and framing is None else framing
+        self.buffer = bytearray()
+        self.poller = None
+        self.binary = binary
+        self.buffer_size = buffer_size
+        self.rbuf = None
+        self.head = self.tail = 0
+        self.queue_size = queue_size
+        self.policy = policy
+        self.outbound = collections.deque()
+        self.drops = 0
+        self.stalls = 0
+        self.partials = 0
+        self.torn = False
+        self.hangup = False
+        self.transport = transport
+        self.ring_size = ring_size
+        self.ring = None
+        self.ring_full = False
 
         # Check the mode to make sure it is one we can use. 
         if self.mode not in FIFO.modes: 
@@ -110,12 +223,35 @@ class FIFO:
                 f"unknown mode {mode}. must be one of {tuple(FIFO.modes.keys())}."
                 )
 
+        if self.framing not in FIFO.framings:
+            raise Exception(
+                f"unknown framing {framing}. must be one of {FIFO.framings}."
+                )
+
+        if self.framing == 'delimiter' and not self.delimiter:
+            raise Exception("delimiter framing requires a delimiter.")
+
+        if self.binary and self.framing != 'length':
+            raise Exception("binary messages must be length framed.")
+
+        if self.policy not in FIFO.policies:
+            raise Exception(
+                f"unknown policy {policy}. must be one of {FIFO.policies}."
+                )
+
+        if self.transport not in FIFO.transports:
+            raise Exception(
+                f"unknown transport {transport}. must be one of {FIFO.transports}."
+                )
+
         try:
             # If the file system entry is already present, and it is a 
             # pipe, try to open it.
             if stat.S_ISFIFO(os.stat(self.name).st_mode):
                 self.fifo = os.open(self.name, FIFO.modes[self.mode])
                 tombstone(f"{self.name} is reopened")
+                if pipe_size: self.set_pipe_size(pipe_size)
+                if transport == 'shm': self.open_ring()
                 return
 
             else:
@@ -145,6 +281,8 @@ class FIFO:
             tombstone(f"created new FIFO {self.name}")
             self.fifo = os.open(self.name, FIFO.modes[self.mode])
             tombstone(f"{self.name} is open in mode <{self.mode}>")
+            if pipe_size: self.set_pipe_size(pipe_size)
+            if transport == 'shm': self.open_ring()
         
         except Exception as e:
             # We must not have permissions or something else at the OS level.
@@ -183,6 +321,9 @@ class FIFO:
             NOTE: the poll object uses milliseconds.
         """
 
+        if self.ring is not None: return self.read_ring(how_long)
+        if self.framing is not None: return self.read_frames(how_long)
+
         data = None
         poll = select.poll()
         poll.register(self.fifo, select.POLLIN)
@@ -205,21 +346,842 @@ class FIFO:
             return data
                 
 
+    def poll(self, how_long:float) -> bool:
+        """
+        Wait for data, using one poll object for the life of the 
+        pipe rather than building one for every read.
+
+        returns -- True if there is something to read.
+        """
+        if self.poller is None:
+            self.poller = select.poll()
+            self.poller.register(self.fifo, select.POLLIN)
+        return not not self.poller.poll(how_long * 1000)
+
+
+    def reopen(self) -> None:
+        """
+        Close and reopen the pipe. After the last writer has gone away,
+        a reader sees a hang-up on every poll until it does this.
+        """
+        self.poller = None
+        try:
+            os.close(self.fifo)
+        except OSError as e:
+            pass
+        self.fifo = os.open(self.name, FIFO.modes[self.mode])
+        tombstone(f"{self.name} is reopened")
+
+
+    def drain(self) -> int:
+        """
+        Append everything that is waiting in the pipe to the buffer.
+        After the first read, we only read again if poll says there is
+        more, so that a pipe opened in 'block' mode never blocks here.
+
+        returns -- the number of bytes read. If it is zero because the
+            last writer has gone, hangup is set.
+        """
+        if self.binary: return self.drain_binary()
+
+        n = 0
+        self.hangup = False
+        while True:
+            try:
+                chunk = os.read(self.fifo, FIFO.read_size)
+            except BlockingIOError as e:
+                break
+
+            if not chunk:
+                self.hangup = not n
+                break
+            self.buffer += chunk
+            n += len(chunk)
+            if len(chunk) < FIFO.read_size or not self.poll(0): break
+
+        return n
+
+
+    def frames(self) -> List[str]:
+        """
+        Remove the complete messages from the buffer.
+        """
+        messages = []
+        if self.framing == 'length':
+            start = 0
+            while len(self.buffer) - start >= 4:
+                size, = struct.unpack_from('>I', self.buffer, start)
+                if len(self.buffer) - start - 4 < size: break
+                messages.append(self.buffer[start+4:start+4+size].decode('utf-8'))
+                start += 4 + size
+            del self.buffer[:start]
+
+        else:
+            *parts, rest = self.buffer.split(self.delimiter.encode('utf-8'))
+            self.buffer = rest
+            messages = [ _.decode('utf-8') for _ in parts ]
+
+        return [ _ for _ in messages 
+            if _ and not (self.ignore and _.startswith(self.ignore)) ]
+
+
+    def messages(self) -> List[str]:
+        """
+        Remove the messages from the buffer: the complete frames if the
+        pipe is framed, and otherwise everything, split on the delimiter.
+        """
+        if self.binary: return self.binary_frames()
+        if self.framing is not None: return self.frames()
+
+        data = self.buffer.decode('utf-8')
+        self.buffer = bytearray()
+        return [ _ for _ in (data.split(self.delimiter) if self.delimiter else [data])
+            if _ and not (self.ignore and _.startswith(self.ignore)) ]
+
+
+    def read_frames(self, how_long:float) -> List[str]:
+        """
+        Wait for data, drain the pipe, and return every complete message.
+
+        how_long : in seconds, how long to wait.
+
+        returns -- the messages, possibly none if the wait timed out
+            or only part of a message has arrived so far.
+        """
+        deadline = time.time() + how_long
+        while self.poll(max(0, deadline - time.time())):
+            if self.drain() or not self.hangup: break
+            # The last writer has gone, and until another one comes, 
+            # poll would report the hang-up at once, every time.
+            self.reopen()
+        return self.messages()
+
+
+    def encode(self, messages:List[str]) -> bytes:
+        """
+        Put the messages in the form written to the pipe.
+        """
+        if self.binary:
+            return b''.join(struct.pack('>I', memoryview(_).nbytes) + bytes(_) 
+                for _ in messages)
+
+        if self.framing == 'length':
+            encoded = [ _.encode('utf-8') for _ in messages ]
+            return b''.join(struct.pack('>I', len(_)) + _ for _ in encoded)
+
+        return ''.join(_ + self.delimiter for _ in messages).encode('utf-8')
+
+
+    ###
+    # Binary messages.
+    ###
+
+    def drain_binary(self) -> int:
+        """
+        Read what is waiting into the reusable buffer with os.readv. 
+        Consumed messages are first squeezed out of the front of the 
+        buffer. The buffer only grows when one message will not fit.
+
+        returns -- the number of bytes read.
+        """
+        if self.rbuf is None: self.rbuf = bytearray(self.buffer_size)
+        if self.head:
+            self.rbuf[:self.tail-self.head] = self.rbuf[self.head:self.tail]
+            self.tail -= self.head
+            self.head = 0
+
+        n = 0
+        self.hangup = False
+        while True:
+            if self.tail == len(self.rbuf):
+                if self.tail < 4 or struct.unpack_from('>I', self.rbuf)[0] + 4 <= self.tail: 
+                    break
+                self.rbuf.extend(bytes(struct.unpack_from('>I', self.rbuf)[0] + 4 - self.tail))
+
+            try:
+                with memoryview(self.rbuf) as view:
+                    count = os.readv(self.fifo, [view[self.tail:]])
+            except BlockingIOError as e:
+                break
+
+            self.hangup = not count and not n
+            self.tail += count
+            n += count
+            if not count or self.tail < len(self.rbuf) and not self.poll(0): break
+
+        return n
+
+
+    def binary_frames(self, copy:bool=True) -> List[Union[bytes, memoryview]]:
+        """
+        Remove the complete messages from the buffer.
+
+        copy -- if False, the messages are memoryviews into the read 
+            buffer, with no copying at all. They are only good until the
+            next read, and must be released before it.
+        """
+        messages = []
+        if self.rbuf is None: return messages
+
+        view = memoryview(self.rbuf)
+        while self.tail - self.head >= 4:
+            size, = struct.unpack_from('>I', self.rbuf, self.head)
+            if self.tail - self.head - 4 < size: break
+            start = self.head + 4
+            messages.append(bytes(view[start:start+size]) if copy else view[start:start+size])
+            self.head = start + size
+
+        if self.head == self.tail: self.head = self.tail = 0
+        return messages
+
+
+    def read_binary(self, how_long:float, copy:bool=True) -> List[Union[bytes, memoryview]]:
+        """
+        Wait for data, drain the pipe, and return every complete message.
+        See binary_frames() for copy.
+        """
+        deadline = time.time() + how_long
+        while self.poll(max(0, deadline - time.time())):
+            if self.drain_binary() or not self.hangup: break
+            self.reopen()
+        return self.binary_frames(copy)
+
+
+    def writev(self, buffers:List[object]) -> int:
+        """
+        Write the buffers, in order, with as few calls to os.writev as
+        possible, finishing any partial write. When the pipe is full we
+        wait for it to drain.
+
+        returns -- the number of bytes written.
+        """
+        views = [ memoryview(_).cast('B') for _ in buffers ]
+        written = i = 0
+        poll = None
+        while i < len(views):
+            try:
+                n = os.writev(self.fifo, views[i:i+FIFO.iov_max])
+            except BlockingIOError as e:
+                if poll is None:
+                    poll = select.poll()
+                    poll.register(self.fifo, select.POLLOUT)
+                poll.poll()
+                continue
+
+            written += n
+            while n and i < len(views):
+                if n >= len(views[i]):
+                    n -= len(views[i])
+                    i += 1
+                else:
+                    views[i] = views[i][n:]
+                    n = 0
+
+        return written
+
+
+    def write_binary(self, messages:List[object]) -> int:
+        """
+        Write the messages, each preceded by its length, without joining
+        or otherwise copying them.
+
+        returns -- the number of bytes written.
+        """
+        buffers = []
+        for m in messages:
+            m = memoryview(m)
+            buffers.append(struct.pack('>I', m.nbytes))
+            buffers.append(m)
+        return self.writev(buffers)
+
+
+    def splice_to(self, target:Union[int, object], count:int=None) -> int:
+        """
+        Move raw data (headers and all) from the pipe to a file. Anything
+        already in the read buffer is written first. Where os.splice 
+        exists, the kernel moves the rest without copying it through
+        user space.
+
+        target -- a file descriptor, or an object with fileno().
+        count  -- the most bytes to move. By default, what is waiting.
+
+        returns -- the number of bytes moved.
+        """
+        fd = target if isinstance(target, int) else target.fileno()
+        moved = 0
+        if self.rbuf is not None and self.tail > self.head:
+            with memoryview(self.rbuf) as view:
+                moved = os.write(fd, view[self.head:self.tail])
+            self.head = self.tail = 0
+
+        while count is None or moved < count:
+            size = FIFO.read_size if count is None else min(count - moved, FIFO.read_size)
+            try:
+                if hasattr(os, 'splice'):
+                    n = os.splice(self.fifo, fd, size)
+                else:
+                    n = os.write(fd, os.read(self.fifo, size))
+            except BlockingIOError as e:
+                break
+            if not n: break
+            moved += n
+
+        return moved
+
+
+    ###
+    # The shared memory transport.
+    ###
+
+    def open_ring(self) -> None:
+        """
+        The reader creates the ring, and the writer attaches to it. The
+        name of the shared memory comes from the name of the pipe.
+        """
+        name = 'fifo.' + hashlib.sha1(self.name.encode('utf-8')).hexdigest()[:20]
+        self.ring = ShmRing(name, self.ring_size, create=self.mode != 'w')
+        tombstone(f"{self.name} is using {self.ring}")
+
+
+    def read_ring(self, how_long:float) -> List[Union[str, bytes]]:
+        """
+        Take the messages from the ring. If there are none, tell the 
+        writer we are idle, and wait on the doorbell.
+        """
+        records = self.ring.get()
+        if not records and how_long:
+            self.ring.idle = True
+            deadline = time.time() + how_long
+            while True:
+                records = self.ring.get()
+                remaining = deadline - time.time()
+                if records or remaining <= 0: break
+                if self.poll(min(remaining, FIFO.doorbell_slice)):
+                    try:
+                        # An empty read means the writer went away.
+                        if not os.read(self.fifo, FIFO.read_size): self.reopen()
+                    except BlockingIOError as e:
+                        pass
+            self.ring.idle = False
+
+        if self.binary: return records
+        messages = [ _.decode('utf-8') for _ in records ]
+        return [ _ for _ in messages 
+            if _ and not (self.ignore and _.startswith(self.ignore)) ]
+
+
+    def write_ring(self, messages:List[object]) -> int:
+        """
+        Put the messages in the ring, and ring the doorbell if the 
+        reader is asleep.
+
+        returns -- the number of bytes written, or zero if the ring is full.
+        """
+        if isinstance(messages, (bytes, bytearray, memoryview)): messages = [messages]
+        records = [ _ if self.binary else _.encode('utf-8') for _ in messages ]
+        try:
+            room = self.ring.put(records)
+        except Exception as e:
+            # Larger than the whole ring.
+            self.drops += 1
+            tombstone(str(e))
+            return 0
+
+        # A producer that gets ahead of the reader may find the ring full
+        # many thousands of times, so only say so once until it clears.
+        if not room:
+            self.drops += 1
+            if not self.ring_full:
+                self.ring_full = True
+                tombstone(f"{self.ring} is full; writes are dropped until there is room.")
+            return 0
+
+        if self.ring_full:
+            self.ring_full = False
+            tombstone(f"{self.ring} has room again; {self.drops} writes dropped so far.")
+
+        if self.ring.idle:
+            self.ring.idle = False
+            try:
+                os.write(self.fifo, b'\0')
+            except BlockingIOError as e:
+                # The pipe is full of doorbells already.
+                pass
+
+        return sum(memoryview(_).nbytes for _ in records)
+
+
+    ###
+    # Pipe capacity and the outbound queue.
+    ###
+
+    @property
+    def capacity(self) -> int:
+        """
+        The size of the pipe's buffer in the kernel.
+        """
+        return fcntl.fcntl(self.fifo, F_GETPIPE_SZ)
+
+
+    def set_pipe_size(self, size:int) -> int:
+        """
+        Ask the kernel for a pipe of this size. Unprivileged processes
+        are limited by /proc/sys/fs/pipe-max-size.
+
+        returns -- the size actually granted.
+        """
+        try:
+            return fcntl.fcntl(self.fifo, F_SETPIPE_SZ, size)
+        except OSError as e:
+            tombstone(f"cannot make {self.name} {size} bytes: {e}")
+            return self.capacity
+
+
+    @property
+    def stats(self) -> dict:
+        return { 'queued': len(self.outbound), 'drops': self.drops, 
+            'stalls': self.stalls, 'partials': self.partials }
+
+
+    def units(self, messages:List[object]) -> List[List[memoryview]]:
+        """
+        Turn the messages into the units that go on the outbound queue:
+        one per message if the pipe is framed, and otherwise the whole
+        lot joined with the delimiter, as write() has always done.
+        """
+        if self.binary:
+            units = []
+            for m in messages:
+                m = memoryview(m).cast('B')
+                units.append([memoryview(struct.pack('>I', m.nbytes)), m])
+            return units
+
+        if self.framing is not None:
+            return [ [memoryview(self.encode([m]))] for m in messages ]
+
+        return [ [memoryview(self.delimiter.join(messages).encode('utf-8'))] ]
+
+
+    def wait_writable(self, how_long:float=None) -> bool:
+        """
+        Wait for room in the pipe. None means as long as it takes.
+        """
+        poll = select.poll()
+        poll.register(self.fifo, select.POLLOUT)
+        return not not poll.poll(None if how_long is None else how_long * 1000)
+
+
+    def flush(self, how_long:float=None, until:int=0) -> bool:
+        """
+        Write from the outbound queue until no more than until messages
+        are left, waiting up to how_long seconds (None is forever) for 
+        the reader to make room.
+
+        returns -- True if the queue got that short. False if the time
+            ran out, or if the reader has gone; then hangup is set.
+        """
+        deadline = None if how_long is None else time.time() + how_long
+        while len(self.outbound) > until:
+            # A message no larger than PIPE_BUF goes out whole, along
+            # with as many of those behind it as fit.
+            buffers = list(self.outbound[0])
+            size = sum(len(_) for _ in buffers)
+            if size <= select.PIPE_BUF:
+                for unit in itertools.islice(self.outbound, 1, None):
+                    unit_size = sum(len(_) for _ in unit)
+                    if size + unit_size > select.PIPE_BUF or \
+                        len(buffers) + len(unit) > FIFO.iov_max: break
+                    buffers.extend(unit)
+                    size += unit_size
+
+            try:
+                n = os.writev(self.fifo, buffers[:FIFO.iov_max])
+
+            except BlockingIOError as e:
+                self.stalls += 1
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0: return False
+                self.wait_writable(remaining)
+                continue
+
+            except OSError as e:
+                # The reader is gone. The rest of a torn message would
+                # only confuse the next one, and under drop_oldest, so
+                # would everything else that was waiting.
+                self.hangup = True
+                lost = len(self.outbound) if self.policy == 'drop_oldest' else int(self.torn)
+                for i in range(lost): self.outbound.popleft()
+                self.drops += lost
+                self.torn = False
+                tombstone(f"cannot write to {self.name}: {e}; {lost} messages dropped, {len(self.outbound)} kept.")
+                return False
+
+            # Take the bytes written off the front of the queue.
+            while n:
+                unit = self.outbound[0]
+                while n and unit:
+                    if n >= len(unit[0]):
+                        n -= len(unit.pop(0))
+                    else:
+                        unit[0] = unit[0][n:]
+                        n = 0
+                if unit:
+                    self.partials += 1
+                    self.torn = True
+                else:
+                    self.outbound.popleft()
+                    self.torn = False
+
+        return True
+
+
+    def send(self, messages:Union[object, List[object]]) -> int:
+        """
+        Queue the messages and write as much as the pipe will take 
+        without waiting. When the queue is full, follow the policy.
+
+        returns -- the number of messages accepted, or 0 if the reader
+            has gone.
+
+        raises -- FIFOFull under the 'error' policy, and Exception if
+            there is no queue.
+        """
+        if self.queue_size <= 0:
+            raise Exception(f"{self.name} has no outbound queue (queue_size={self.queue_size}). Use write().")
+
+        if isinstance(messages, (str, bytes, bytearray, memoryview)): messages = [messages]
+        accepted = 0
+        self.hangup = False
+        units = self.units(messages)
+        for unit in units:
+            if len(self.outbound) >= self.queue_size:
+                self.flush(0, self.queue_size - 1)
+
+            if len(self.outbound) >= self.queue_size:
+                if self.policy == 'error':
+                    self.drops += 1
+                    raise FIFOFull(f"{self.name} outbound queue is full ({self.queue_size}).")
+
+                elif self.policy == 'drop_oldest':
+                    # A message that is partly written must be finished.
+                    victim = 1 if self.torn else 0
+                    if victim < len(self.outbound):
+                        del self.outbound[victim]
+                        self.drops += 1
+
+                else:
+                    self.flush(None, self.queue_size - 1)
+
+            if self.hangup:
+                self.drops += len(units) - accepted
+                return 0
+            self.outbound.append(unit)
+            accepted += 1
+
+        self.flush(0)
+        return 0 if self.hangup else accepted
+
+
+    def close(self, how_long:float=None) -> None:
+        """
+        Finish writing the queue (waiting up to how_long seconds), and
+        close the pipe.
+        """
+        if self.outbound and not self.flush(how_long):
+            self.drops += len(self.outbound)
+            tombstone(f"{len(self.outbound)} messages to {self.name} were never sent.")
+        if self.ring is not None: self.ring.close()
+        os.close(self.fifo)
+
+
     @trap
     def write(self, messages:List[str]) -> int:
         """
         write messages to the fifo.
+
+        returns -- the number of bytes written, or with a queue, the 
+            number of messages accepted. Zero means they were dropped.
         """
 
-        # We need to join the list with the delimiter.
         if isinstance(messages, str): messages = [messages]
+        if self.ring is not None: return self.write_ring(messages)
+        if self.queue_size:
+            try:
+                return self.send(messages)
+            except FIFOFull as e:
+                tombstone(str(e))
+                return 0
+
+        if self.binary:
+            if isinstance(messages, (bytes, bytearray, memoryview)): messages = [messages]
+            try:
+                return self.write_binary(messages)
+            except Exception as e:
+                tombstone(str(e))
+                return 0
+
+        if self.framing is not None:
+            payload = self.encode(messages)
+            try:
+                n = os.write(self.fifo, payload)
+            except Exception as e:
+                # Nothing was written, so the stream is still intact.
+                self.drops += 1
+                tombstone(str(e))
+                return 0
+
+            # A frame cut short would leave the reader waiting for the 
+            # rest of it, so the rest must follow, however long it takes.
+            if n < len(payload): 
+                self.partials += 1
+                try:
+                    n += self.writev([memoryview(payload)[n:]])
+                except OSError as e:
+                    # The reader went away in the middle of the frame.
+                    self.drops += 1
+                    tombstone(str(e))
+                    return 0
+            return n
+
+        # We need to join the list with the delimiter.
         messages = self.delimiter.join(messages)
         try:
             os.write(self.fifo, messages.encode('utf-8'))
 
         except Exception as e:
+            self.drops += 1
             tombstone(str(e))
             return 0
 
         else:
             return len(messages)
+
+
+class FIFOServer:
+    """
+    Serve many FIFOs from one process. There is one epoll object with
+    a persistent registration for each pipe, and each pipe has its own
+    callback, which is called with the pipe and the list of messages
+    that arrived. When the last writer to a pipe goes away, the pipe
+    is reopened rather than ending the process.
+
+    Usage:
+
+        server = FIFOServer()
+        server.add(FIFO('jobs', framing='length'), handle_jobs)
+        server.add(FIFO('control', delimiter=';'), handle_control)
+        server.run()
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.pipes = {}
+        self.running = False
+        self.hangups = 0
+
+
+    def __len__(self) -> int:
+        return len(self.pipes)
+
+
+    def add(self, pipe:FIFO, callback:Callable[[FIFO, List[str]], None]) -> None:
+        """
+        Start watching a pipe that is open for reading.
+        """
+        if pipe.mode == 'w': raise Exception(f"{pipe.name} is not open for reading.")
+        self.epoll.register(pipe.fifo, select.EPOLLIN)
+        self.pipes[pipe.fifo] = (pipe, callback)
+
+
+    def remove(self, pipe:FIFO) -> None:
+        """
+        Stop watching a pipe. The pipe is left open.
+        """
+        if self.pipes.pop(pipe.fifo, None) is not None:
+            self.epoll.unregister(pipe.fifo)
+
+
+    def poll(self, how_long:float=-1) -> int:
+        """
+        Wait up to how_long seconds (forever if negative) for any of the
+        pipes, read what has arrived, and call the callbacks.
+
+        returns -- the number of messages dispatched.
+        """
+        n = 0
+        for fd, events in self.epoll.poll(how_long):
+            pipe, callback = self.pipes[fd]
+            if events & select.EPOLLIN:
+                pipe.drain()
+                messages = pipe.messages()
+                if messages:
+                    n += len(messages)
+                    callback(pipe, messages)
+
+            if events & (select.EPOLLHUP | select.EPOLLERR):
+                # Take anything the writer left behind before reopening.
+                pipe.drain()
+                messages = pipe.messages()
+                if messages:
+                    n += len(messages)
+                    callback(pipe, messages)
+                self.hangups += 1
+                self.remove(pipe)
+                pipe.reopen()
+                self.add(pipe, callback)
+
+        return n
+
+
+    def run(self, how_long:float=None) -> None:
+        """
+        Serve until stop() is called, or for how_long seconds.
+        """
+        self.running = True
+        quitting_time = None if how_long is None else time.time() + how_long
+        while self.running:
+            if quitting_time is None:
+                self.poll(1.0)
+            else:
+                remaining = quitting_time - time.time()
+                if remaining <= 0: break
+                self.poll(min(remaining, 1.0))
+
+
+    def stop(self) -> None:
+        self.running = False
+
+
+    def close(self) -> None:
+        """
+        Stop watching, and close all the pipes.
+        """
+        for pipe, callback in list(self.pipes.values()):
+            self.remove(pipe)
+            os.close(pipe.fifo)
+        self.epoll.close()
+
+
+class AsyncFIFO:
+    """
+    An asyncio reader or writer for a FIFO. The descriptor is made
+    non-blocking and watched with loop.add_reader or loop.add_writer,
+    so one event loop can serve hundreds of pipes without threads.
+
+    Usage:
+
+        async for message in AsyncFIFO('jobs', framing='length'):
+            ...
+
+        out = AsyncFIFO('jobs', 'w', framing='length')
+        await out.write(['one', 'two'])
+    """
+
+    def __init__(self, pipe:Union[FIFO, str], mode:str='non_block', **kwargs):
+        """
+        pipe   -- a FIFO, or the name of one to open with mode and kwargs.
+        """
+        self.pipe = pipe if isinstance(pipe, FIFO) else FIFO(pipe, mode, **kwargs)
+        os.set_blocking(self.pipe.fifo, False)
+        self.loop = None
+        self.queue = None
+        self.lock = None
+
+
+    def __str__(self) -> str:
+        return str(self.pipe)
+
+
+    def start(self) -> None:
+        """
+        Attach to the running loop. Reading starts at once.
+        """
+        if self.loop is not None: return
+        self.loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+        if self.pipe.mode != 'w':
+            self.queue = asyncio.Queue()
+            self.loop.add_reader(self.pipe.fifo, self.readable)
+
+
+    def readable(self) -> None:
+        """
+        Callback from the loop: take what is in the pipe and queue the
+        complete messages. Only an end of file is a hang-up; a wakeup
+        with nothing to read (EAGAIN) is not.
+        """
+        if not self.pipe.drain() and self.pipe.hangup:
+            self.loop.remove_reader(self.pipe.fifo)
+            self.pipe.reopen()
+            os.set_blocking(self.pipe.fifo, False)
+            self.loop.add_reader(self.pipe.fifo, self.readable)
+            return
+
+        for message in self.pipe.messages():
+            self.queue.put_nowait(message)
+
+
+    def __aiter__(self) -> 'AsyncFIFO':
+        return self
+
+
+    async def __anext__(self) -> str:
+        self.start()
+        return await self.queue.get()
+
+
+    async def read(self) -> List[str]:
+        """
+        Wait for at least one message.
+
+        returns -- every message that has arrived.
+        """
+        self.start()
+        messages = [ await self.queue.get() ]
+        while not self.queue.empty():
+            messages.append(self.queue.get_nowait())
+        return messages
+
+
+    async def writable(self) -> None:
+        """
+        Wait until the pipe has room.
+        """
+        ready = self.loop.create_future()
+        self.loop.add_writer(self.pipe.fifo, ready.set_result, None)
+        try:
+            await ready
+        finally:
+            self.loop.remove_writer(self.pipe.fifo)
+
+
+    async def write(self, messages:Union[object, List[object]]) -> int:
+        """
+        Write the messages, waiting whenever the pipe is full rather
+        than dropping them. Writes from different tasks are not 
+        interleaved.
+
+        returns -- the number of bytes written.
+        """
+        self.start()
+        if isinstance(messages, (str, bytes, bytearray, memoryview)): messages = [messages]
+        if self.pipe.framing is not None:
+            payload = memoryview(self.pipe.encode(messages))
+        else:
+            payload = memoryview(self.pipe.delimiter.join(messages).encode('utf-8'))
+
+        async with self.lock:
+            written = 0
+            while written < len(payload):
+                try:
+                    written += os.write(self.pipe.fifo, payload[written:])
+                except BlockingIOError as e:
+                    await self.writable()
+
+        return written
+
+
+    def close(self) -> None:
+        if self.loop is not None and self.pipe.mode != 'w':
+            self.loop.remove_reader(self.pipe.fifo)
+        os.close(self.pipe.fifo)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Fan the messages arriving on one FIFO out to a pool of worker processes.
+
+A single reader that handles each job itself uses one core, and CPU-bound
+jobs pile up in the pipe while the other cores sit idle. The dispatcher
+reads the messages and hands them to a concurrent.futures process pool,
+never holding more than max_in_flight of them at once. When it is full,
+it stops reading, the pipe fills, and the writers feel the backpressure.
+
+Usage:
+
+    from fifodispatcher import FIFODispatcher
+
+    def crunch(message:str) -> str:
+        # Runs in a worker process, so it must be importable (defined
+        # at the top level of a module).
+        ...
+
+    FIFODispatcher('jobs.pipe', crunch,
+        key='account',       # jobs for one account run in order
+        reply='reply_to'     # the result goes to the FIFO the job names
+        ).run()
+
+Messages are strings. key and reply may each be the name of a field in
+a message that is a JSON object, or a function that takes the message
+and returns the key (or the name of the reply FIFO). Messages without a
+key are unordered. A handler's result is sent to the reply FIFO if it
+is a str, and as JSON if it is anything else other than None. A handler
+that raises is logged and counted, and sends nothing.
+"""
+
+import typing
+from   typing import *
+
+import collections
+import concurrent.futures
+import json
+import os
+import queue
+import select
+import time
+
+from   fifo import FIFO
+from   tombstone import tombstone
+
+# Credits
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2020'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'me@georgeflanagin.com'
+__status__ = 'Prototype'
+
+__license__ = 'MIT'
+
+
+def field_of(name:str) -> Callable[[str], object]:
+    """
+    returns -- a function that finds the named field of a JSON message,
+        or None if there is no such field.
+    """
+    def finder(message:str) -> object:
+        try:
+            return json.loads(message).get(name)
+        except (ValueError, AttributeError) as e:
+            return None
+    return finder
+
+
+class FIFODispatcher:
+    """
+    One FIFO in, a process pool to do the work, and optionally a reply
+    FIFO for each client.
+    """
+
+    # The latency percentiles are over this many of the most recent
+    # messages.
+    latency_window = 10000
+
+    def __init__(self, pipe_name:str, handler:Callable[[str], object], *,
+        processes:int=None,
+        max_in_flight:int=None,
+        key:Union[str, Callable[[str], object]]=None,
+        reply:Union[str, Callable[[str], str]]=None,
+        **kwargs):
+        """
+        pipe_name     -- the FIFO the jobs arrive on. It is created if
+            need be.
+        handler       -- called in a worker with each message.
+        processes     -- the size of the pool. The default is one per CPU.
+        max_in_flight -- the most messages held at once, whether running
+            or waiting behind another message with the same key. The
+            default is twice the number of processes.
+        key           -- None for unordered dispatch. Otherwise, messages
+            with the same key are handled one at a time, in the order
+            they arrived.
+        reply         -- how to find the name of the FIFO for the result.
+        kwargs        -- passed along to the FIFOs. The default is one
+            message per line.
+        """
+        kwargs.setdefault('framing', 'delimiter')
+        kwargs.setdefault('delimiter', '\n')
+        self.kwargs = kwargs
+        self.handler = handler
+        self.key = field_of(key) if isinstance(key, str) else key
+        self.reply = field_of(reply) if isinstance(reply, str) else reply
+
+        self.requests = FIFO(pipe_name, 'non_block', **kwargs)
+        # Hold the pipe open for writing ourselves, so that the reader
+        # never sees a hang-up when the last writer goes away.
+        self.keepalive = os.open(self.requests.name, os.O_WRONLY | os.O_NONBLOCK)
+
+        self.processes = processes or os.cpu_count()
+        self.max_in_flight = max_in_flight or 2 * self.processes
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.processes)
+
+        # Finished futures come back through this queue, and a byte on
+        # the wakeup pipe tells the loop to look.
+        self.finished = queue.SimpleQueue()
+        self.wakeup_r, self.wakeup_w = os.pipe2(os.O_NONBLOCK)
+        self.poller = select.poll()
+        self.poller.register(self.requests.fifo, select.POLLIN)
+        self.poller.register(self.wakeup_r, select.POLLIN)
+
+        self.backlog = collections.deque()
+        self.waiting = {}
+        self.in_flight = {}
+        self.replies = {}
+        self.running = False
+
+        self.received = 0
+        self.completed = 0
+        self.failures = 0
+        self.stalls = 0
+        self.cancelled = 0
+        self.latencies = collections.deque(maxlen=FIFODispatcher.latency_window)
+
+
+    def __enter__(self) -> 'FIFODispatcher':
+        return self
+
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+    def __len__(self) -> int:
+        """
+        The number of messages held: running, or waiting for their key.
+        """
+        return len(self.in_flight) + sum(len(_) for _ in self.waiting.values())
+
+
+    ###
+    # Moving messages to the pool, and the results back.
+    ###
+
+    def _done(self, future:concurrent.futures.Future) -> None:
+        """
+        Called in the pool's management thread.
+        """
+        self.finished.put(future)
+        try:
+            os.write(self.wakeup_w, b'.')
+        except BlockingIOError as e:
+            # The loop has plenty of wakeups already.
+            pass
+
+
+    def _submit(self, message:str, key:object) -> None:
+        future = self.pool.submit(self.handler, message)
+        self.in_flight[future] = (message, key, time.perf_counter())
+        future.add_done_callback(self._done)
+
+
+    def dispatch(self) -> None:
+        """
+        Move messages from the backlog to the pool, as long as there is
+        room. A message whose key is busy waits behind the one before it.
+        """
+        while self.backlog and len(self) < self.max_in_flight:
+            message = self.backlog.popleft()
+            key = None if self.key is None else self.key(message)
+            if key is None:
+                self._submit(message, None)
+            elif key in self.waiting:
+                self.waiting[key].append(message)
+            else:
+                self.waiting[key] = collections.deque()
+                self._submit(message, key)
+
+
+    def respond(self, message:str, result:object) -> None:
+        """
+        Send the result to the FIFO the message asked for, if it is
+        still there.
+        """
+        if self.reply is None or result is None: return
+        client = self.reply(message)
+        if not client: return
+
+        try:
+            if client not in self.replies:
+                self.replies[client] = FIFO(client, 'w', queue_size=self.max_in_flight,
+                    policy='drop_oldest', **self.kwargs)
+            self.replies[client].send(result if isinstance(result, str) else json.dumps(result))
+            if self.replies[client].hangup: raise Exception('it stopped reading')
+
+        except Exception as e:
+            tombstone(f"client {client} is gone: {e}")
+            self.replies.pop(client, None)
+
+
+    def collect(self) -> int:
+        """
+        Deal with the futures that have finished: reply, and let the
+        next message with the same key go.
+
+        returns -- the number collected.
+        """
+        try:
+            while True: os.read(self.wakeup_r, 4096)
+        except BlockingIOError as e:
+            pass
+
+        n = 0
+        while True:
+            try:
+                future = self.finished.get_nowait()
+            except queue.Empty as e:
+                break
+
+            n += 1
+            message, key, started = self.in_flight.pop(future)
+            self.latencies.append(time.perf_counter() - started)
+            self.completed += 1
+            if future.cancelled():
+                # The pool went away before the job ran.
+                self.cancelled += 1
+                tombstone(f"cancelled before handling {message[:80]}")
+            else:
+                try:
+                    self.respond(message, future.result())
+                except Exception as e:
+                    self.failures += 1
+                    tombstone(f"handler failed on {message[:80]}: {e}")
+
+            if key is not None:
+                if self.waiting[key]:
+                    self._submit(self.waiting[key].popleft(), key)
+                else:
+                    del self.waiting[key]
+
+        return n
+
+
+    ###
+    # The loop.
+    ###
+
+    def step(self, timeout:float=1.0, reading:bool=True) -> None:
+        """
+        Wait up to timeout seconds for something to happen, and deal
+        with it. While full, watch only for finished work; the pipe 
+        will wait.
+        """
+        for name, client in list(self.replies.items()):
+            if client.outbound and not client.flush(0) and client.hangup:
+                tombstone(f"client {name} is gone.")
+                del self.replies[name]
+
+        if reading and (len(self) >= self.max_in_flight or self.backlog):
+            self.stalls += 1
+            reading = False
+        self.poller.modify(self.requests.fifo, select.POLLIN if reading else 0)
+
+        for fd, event in self.poller.poll(timeout * 1000):
+            if fd == self.wakeup_r:
+                self.collect()
+            else:
+                messages = self.requests(0)
+                self.received += len(messages)
+                self.backlog.extend(messages)
+
+        self.dispatch()
+
+
+    def run(self, how_long:float=None) -> None:
+        """
+        Dispatch messages until stop() is called, or for how_long seconds.
+        """
+        self.running = True
+        quitting_time = None if how_long is None else time.time() + how_long
+        while self.running and (quitting_time is None or time.time() < quitting_time):
+            self.step(1.0 if quitting_time is None else
+                max(0, min(1.0, quitting_time - time.time())))
+
+
+    def stop(self) -> None:
+        self.running = False
+
+
+    def stats(self) -> dict:
+        """
+        returns -- counts, and latency percentiles in milliseconds over
+            the most recent latency_window messages.
+        """
+        ordered = sorted(self.latencies)
+        def percentile(p:float) -> float:
+            return 1000 * ordered[min(len(ordered)-1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+        return { 'received': self.received, 'completed': self.completed,
+            'held': len(self), 'backlog': len(self.backlog),
+            'failures': self.failures, 'cancelled': self.cancelled, 'stalls': self.stalls,
+            'p50': percentile(50), 'p95': percentile(95), 'p99': percentile(99) }
+
+
+    def close(self, how_long:float=30) -> None:
+        """
+        Finish the work that was already read (but not what is still in
+        the pipe), and release everything.
+        """
+        deadline = time.time() + how_long
+        while (self.in_flight or self.backlog) and time.time() < deadline:
+            self.step(min(1.0, max(0, deadline - time.time())), reading=False)
+
+        self.pool.shutdown()
+        for client in self.replies.values():
+            client.close(1.0)
+        for fd in (self.keepalive, self.wakeup_r, self.wakeup_w, self.requests.fifo):
+            os.close(fd)
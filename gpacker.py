@@ -1,16 +1,75 @@
 # -*- coding: utf-8 -*-
-""" Wrapper for basic pickle + bz2 operations """
+"""
+Wrapper for basic pickle + bz2 operations
+
+Files begin with a six byte header (magic, format version, codec, and
+level), so that read() knows how the pickle was compressed. The codecs
+are 'none', 'zlib' (levels 1-9), 'bz2' (1-9), and 'lzma' (presets 0-9).
+With codec='auto', write() compresses a sample of the pickle with each
+of the candidates, and picks the one that best meets the target: the 
+smallest output that is still compressed at throughput MB/s, or the 
+fastest codec that achieves the size ratio (compressed / original).
+
+Files written before there was a header are plain bz2 (or plain 
+pickle), and read() still reads them. read() looks at the first bytes
+of the file to decide how to decode it (bz2, lzma, gzip, and zlib files
+from elsewhere are recognized too), and unpickles from a file object 
+that decompresses as it goes, so the whole file is never in memory.
+
+Parallel. With parallel=N, the pickle is cut into blocks that are bz2
+compressed at the same time on a pool of N processes, and the file is
+the concatenation of the resulting bz2 streams, with no header, so that
+bz2.decompress and bunzip2 read it as they would any other. The last 
+stream holds an index of the blocks, which comes out after the pickle
+and is ignored by pickle.loads. read() uses the index to decompress the
+blocks in parallel.
+
+Archives. A file can also hold many records, each pickled and compressed
+on its own, with an index of keys and offsets in a footer:
+
+    p = Packer(codec='zlib')
+    p.attachIO('nightly.gpk', 'create')     # or 'append' to add more.
+    p.add('2020-01-01', frame1)
+    p.add('2020-01-02', frame2)
+    p.close()                               # writes the index.
+
+    p.attachIO('nightly.gpk', 'read')
+    frame = p.read(key='2020-01-02')        # or p['2020-01-02']
+    for key, frame in p: ...                # one record at a time.
+    p.close()
+
+Only the record asked for is read and decompressed.
+
+Mapped. With codec='mapped', nothing is compressed. The buffers of the
+object (NumPy arrays, and so the columns of a pandas.DataFrame) of at
+least Packer.mapped_threshold bytes (a page) are taken out of the 
+pickle (protocol 5's out-of-band buffers), and each is written on a 
+page boundary of its own; smaller ones stay in the pickle. read() maps the file, 
+and the arrays come back as read-only views of the map: nothing is 
+copied, only the pages that are touched are ever read, and processes
+that load the same file share them in the page cache.
+"""
 
 import typing
 from   typing import *
 
 import bz2
+import collections
+import concurrent.futures
+import gzip
 import json
+import lzma
+import io
 import math
+import mmap
 import os
 import pickle
+import re
+import struct
 import sys
 import tempfile
+import time
+import zlib
 
 try:
     import pandas
@@ -38,6 +97,395 @@ __license__ = 'MIT'
 class Packer: 
     pass
 
+# The header: magic, format version, codec, level.
+magic = b'GPK'
+header = struct.Struct('>3sBBB')
+format_version = 1
+
+codecs = { 'none': 0, 'zlib': 1, 'bz2': 2, 'lzma': 3 }
+codec_names = { v: k for k, v in codecs.items() }
+levels = { 'none': range(0, 1), 'zlib': range(1, 10), 'bz2': range(1, 10), 
+    'lzma': range(0, 10) }
+default_levels = { 'none': 0, 'zlib': 6, 'bz2': 9, 'lzma': 6 }
+
+
+def compressor_for(codec:str, level:int) -> object:
+    """
+    returns -- an incremental compressor, or None for 'none'.
+    """
+    if codec == 'zlib': return zlib.compressobj(level)
+    if codec == 'bz2': return bz2.BZ2Compressor(level)
+    if codec == 'lzma': return lzma.LZMACompressor(preset=level)
+    return None
+
+
+def decompress(codec:str, data:bytes) -> bytes:
+    if codec == 'zlib': return zlib.decompress(data)
+    if codec == 'bz2': return bz2.decompress(data)
+    if codec == 'lzma': return lzma.decompress(data)
+    return data
+
+
+def choose_codec(sample:bytes, *,
+    throughput:float=None,
+    ratio:float=None,
+    candidates:Iterable[Tuple[str, int]]=None) -> Tuple[str, int, list]:
+    """
+    Compress the sample with each candidate, and pick one.
+
+    throughput -- in MB/s. Pick the smallest output among the codecs at 
+        least this fast, or if none are, the fastest.
+    ratio      -- compressed / original. Pick the fastest codec whose 
+        output is at least this small, or if none is, the smallest. 
+        ratio takes precedence over throughput.
+
+    returns -- the codec, the level, and the measurements as a list of
+        (codec, level, MB/s, ratio).
+    """
+    if throughput is None and ratio is None: throughput = Packer.default_throughput
+    measurements = []
+    for codec, level in candidates or Packer.auto_candidates:
+        start = time.perf_counter()
+        c = compressor_for(codec, level)
+        size = len(sample) if c is None else len(c.compress(sample) + c.flush())
+        elapsed = time.perf_counter() - start
+        measurements.append((codec, level, 
+            len(sample) / elapsed / 1e6 if elapsed else math.inf,
+            size / len(sample) if sample else 1.0))
+
+    fastest = lambda m: -m[2]
+    smallest = lambda m: m[3]
+    if ratio is not None:
+        good = [ m for m in measurements if m[3] <= ratio ]
+        best = min(good, key=fastest) if good else min(measurements, key=smallest)
+    else:
+        good = [ m for m in measurements if m[2] >= throughput ]
+        best = min(good, key=smallest) if good else min(measurements, key=fastest)
+
+    return best[0], best[1], measurements
+
+
+# The index of a parallel file: magic and the number of blocks, then
+# the offset, compressed length, and original length of each block.
+index_magic = b'GPKIDX01'
+index_header = struct.Struct('>8sQ')
+index_entry = struct.Struct('>QQQ')
+
+# How bz2 streams begin: 'BZh', the block size, and the first block.
+bz2_stream = re.compile(rb'BZh[1-9]\x31\x41\x59\x26\x53\x59')
+
+
+# How to recognize, from their first bytes, the files written by older 
+# versions and other programs.
+sniffers = {
+    'lzma': lambda lead: lead[:6] == b'\xfd7zXZ\x00',
+    'gzip': lambda lead: lead[:2] == b'\x1f\x8b',
+    'zlib': lambda lead: len(lead) > 1 and lead[0] == 0x78 and (lead[0] * 256 + lead[1]) % 31 == 0,
+    'none': lambda lead: len(lead) > 1 and lead[0] == 0x80 and 2 <= lead[1] <= pickle.HIGHEST_PROTOCOL,
+    }
+
+
+class ZlibReader(io.RawIOBase):
+    """
+    The standard library has file objects that decompress bz2, lzma, 
+    and gzip as they are read, but none for zlib.
+    """
+
+    def __init__(self, unit:object, chunk:int=1<<16) -> None:
+        self.unit = unit
+        self.chunk = chunk
+        self.decompressor = zlib.decompressobj()
+
+
+    def readable(self) -> bool:
+        return True
+
+
+    def readinto(self, b:object) -> int:
+        while True:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            elif self.decompressor.eof:
+                return 0
+            else:
+                data = self.unit.read(self.chunk)
+                if not data: raise EOFError("the zlib stream ended early")
+            out = self.decompressor.decompress(data, len(b))
+            if out:
+                b[:len(out)] = out
+                return len(out)
+
+
+class BlockReader(io.RawIOBase):
+    """
+    A file object that reads from an iterator of blocks.
+    """
+
+    def __init__(self, blocks:Iterator[bytes]) -> None:
+        self.blocks = blocks
+        self.block = memoryview(b'')
+
+
+    def readable(self) -> bool:
+        return True
+
+
+    def readinto(self, b:object) -> int:
+        while not self.block:
+            try:
+                self.block = memoryview(next(self.blocks))
+            except StopIteration as e:
+                return 0
+        n = min(len(b), len(self.block))
+        b[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+
+    def close(self) -> None:
+        self.blocks.close()
+        super().close()
+
+
+def open_codec(codec:str, unit:object) -> object:
+    """
+    returns -- a file object that reads the decompressed data from 
+        unit, starting where it is.
+    """
+    if codec == 'bz2': return bz2.BZ2File(unit)
+    if codec == 'lzma': return lzma.LZMAFile(unit)
+    if codec == 'gzip': return gzip.GzipFile(fileobj=unit)
+    if codec == 'zlib': return io.BufferedReader(ZlibReader(unit))
+    return unit
+
+
+def parallel_blocks(path:str, index:list, processes:int) -> Iterator[bytes]:
+    """
+    Decompress the blocks of a parallel file on a process pool, and
+    yield them in order, with no more than two per process at once.
+    """
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        pending = collections.deque()
+        for offset, length, size in index:
+            pending.append(pool.submit(decompress_block, path, offset, length))
+            if len(pending) >= 2 * processes: yield pending.popleft().result()
+        while pending: yield pending.popleft().result()
+
+
+def compress_block(block:bytes, level:int) -> bytes:
+    """
+    Run in the process pool.
+    """
+    return bz2.compress(block, level)
+
+
+def decompress_block(path:str, offset:int, length:int) -> bytes:
+    """
+    Run in the process pool. Each worker reads its own block, so the
+    compressed data never pass through the parent.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return bz2.decompress(f.read(length))
+
+
+def find_block_index(unit:object, window:int=1<<16, limit:int=1<<20) -> list:
+    """
+    Look for the index stream at the end of a parallel file. Streams 
+    start on a byte boundary, so we try each place in the tail of the
+    file that looks like the start of one, from the end backwards. Each
+    is first asked for only as many bytes as the magic, so that in an
+    ordinary bz2 file no more than one block is decompressed.
+
+    returns -- a list of (offset, length, size) for the blocks, or 
+        None if this is not a parallel file.
+    """
+    end = unit.seek(0, os.SEEK_END)
+    while True:
+        start = max(0, end - window)
+        unit.seek(start)
+        tail = memoryview(unit.read(end - start))
+        for m in reversed(list(bz2_stream.finditer(tail))):
+            try:
+                lead = bz2.BZ2Decompressor().decompress(tail[m.start():], 
+                    max_length=len(index_magic))
+                if lead != index_magic: continue
+                data = bz2.decompress(tail[m.start():])
+            except (OSError, ValueError, EOFError) as e:
+                continue
+            _, n = index_header.unpack_from(data)
+            return [ index_entry.unpack_from(data, index_header.size + i * index_entry.size) 
+                for i in range(n) ]
+
+        if start == 0 or window >= limit: return None
+        window *= 4
+
+
+# An archive begins with the header, with this magic instead, and ends
+# with the pickled, zlib compressed index of its records, and then a
+# trailer giving the index's offset and length.
+archive_magic = b'GPA'
+archive_trailer = struct.Struct('>QQ8s')
+archive_trailer_magic = b'GPAINDEX'
+
+
+# A mapped file begins with the header, with this magic instead, and 
+# ends with the pickle, the offset and length of each buffer, and then
+# a trailer: the offset and length of the pickle, the number of buffers,
+# and the magic again.
+mapped_magic = b'GPM'
+mapped_buffer = struct.Struct('>QQ')
+mapped_trailer = struct.Struct('>QQQ8s')
+mapped_trailer_magic = b'GPMAPPED'
+
+
+class BlockWriter:
+    """
+    A file-like object for pickle.Pickler that cuts the pickle into 
+    blocks, and compresses them on a process pool. The results are
+    written in order, with no more than two blocks per process waiting
+    at once, so memory stays bounded.
+    """
+
+    def __init__(self, unit:object, pool:concurrent.futures.Executor, 
+        processes:int, block_size:int, level:int) -> None:
+        self.unit = unit
+        self.pool = pool
+        self.processes = processes
+        self.block_size = block_size
+        self.level = level
+        self.block = bytearray()
+        self.pending = collections.deque()
+        self.index = []
+        self.offset = unit.tell()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+    def submit(self) -> None:
+        while len(self.pending) >= 2 * self.processes: self.collect()
+        self.pending.append((len(self.block), 
+            self.pool.submit(compress_block, bytes(self.block), self.level)))
+        self.block = bytearray()
+
+
+    def collect(self) -> None:
+        size, future = self.pending.popleft()
+        compressed = future.result()
+        self.unit.write(compressed)
+        self.index.append((self.offset, len(compressed), size))
+        self.offset += len(compressed)
+        self.bytes_out += len(compressed)
+
+
+    def write(self, data:object) -> int:
+        view = memoryview(data).cast('B')
+        i = 0
+        while i < len(view):
+            room = self.block_size - len(self.block)
+            self.block += view[i:i+room]
+            i += room
+            if len(self.block) >= self.block_size: self.submit()
+        self.bytes_in += len(view)
+        return len(view)
+
+
+    def close(self) -> None:
+        if self.block: self.submit()
+        while self.pending: self.collect()
+        index = index_header.pack(index_magic, len(self.index)) + b''.join(
+            index_entry.pack(*_) for _ in self.index)
+        self.unit.write(bz2.compress(index, self.level))
+
+
+class CompressingWriter:
+    """
+    A file-like object for pickle.Pickler: everything written to it goes
+    through an incremental compressor and straight on to the unit, so
+    that neither the pickle nor its compressed form is ever in memory
+    all at once.
+    """
+
+    def __init__(self, unit:object, compressor:object) -> None:
+        self.unit = unit
+        self.compressor = compressor
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+    # Large buffers are fed to the compressor in pieces this size, so
+    # that its output for them is never all in memory at once either.
+    chunk = 1 << 20
+
+    def write(self, data:object) -> int:
+        view = memoryview(data).cast('B')
+        if self.compressor is None:
+            self.bytes_out += self.unit.write(view)
+            self.bytes_in += len(view)
+            return len(view)
+
+        for i in range(0, len(view), CompressingWriter.chunk):
+            compressed = self.compressor.compress(view[i:i+CompressingWriter.chunk])
+            if compressed: self.bytes_out += self.unit.write(compressed)
+        self.bytes_in += len(view)
+        return len(view)
+
+
+    def close(self) -> None:
+        if self.compressor is not None:
+            self.bytes_out += self.unit.write(self.compressor.flush())
+
+
+class SamplingWriter:
+    """
+    For codec='auto': hold the first part of the pickle until there is
+    enough of it to choose a codec, and then write the header and carry
+    on through a CompressingWriter.
+    """
+
+    def __init__(self, unit:object, packer:Packer) -> None:
+        self.unit = unit
+        self.packer = packer
+        self.sample = bytearray()
+        self.sink = None
+
+
+    @property
+    def bytes_in(self) -> int:
+        return self.sink.bytes_in
+
+
+    @property
+    def bytes_out(self) -> int:
+        return self.sink.bytes_out
+
+
+    def start(self) -> None:
+        codec, level, measurements = choose_codec(bytes(self.sample),
+            throughput=self.packer.throughput, ratio=self.packer.ratio)
+        self.packer.verbose and tombstone(f"chose {codec} level {level} from {measurements}")
+        self.sink = self.packer.sink(self.unit, codec, level)
+        self.sink.write(self.sample)
+        self.sample = None
+
+
+    def write(self, data:object) -> int:
+        if self.sink is not None: return self.sink.write(data)
+
+        view = memoryview(data).cast('B')
+        room = self.packer.sample_size - len(self.sample)
+        self.sample += view[:room]
+        if len(self.sample) >= self.packer.sample_size:
+            self.start()
+            if len(view) > room: self.sink.write(view[room:])
+        return len(view)
+
+
+    def close(self) -> None:
+        if self.sink is None: self.start()
+        self.sink.close()
+
+
 class Packer:
     """
     Class to read and write data files without having to
@@ -47,25 +495,69 @@ class Packer:
     """
     
     super_modes = {
-        "create":"wbx",
+        "create":"xb",
         "read":"rb",
         "write":"wb",
         None:"rb",
         "append":"ab"
         }
 
+    # What codec='auto' tries, and the throughput it aims for (MB/s)
+    # when no target is given.
+    auto_candidates = ( ('none', 0), ('zlib', 1), ('zlib', 6), ('bz2', 9), 
+        ('lzma', 0), ('lzma', 6) )
+    default_throughput = 100.0
+
+    # With codec='mapped', buffers smaller than this stay in the pickle,
+    # rather than each taking a page (or more) of its own.
+    mapped_threshold = mmap.PAGESIZE
+
     
     def __init__(self, *,
         verbose:bool=False,
-        encoding:str='utf-8') -> None:
+        encoding:str='utf-8',
+        codec:str='bz2',
+        level:int=None,
+        throughput:float=None,
+        ratio:float=None,
+        sample_size:int=1<<20,
+        parallel:int=0,
+        block_size:int=1<<23) -> None:
         """
         encoding -- essential to converting bytes to strings
+        codec -- 'none', 'zlib', 'bz2', 'lzma', 'auto', or 'mapped'.
+        level -- the compression level (the preset for lzma). The 
+            default is the codec's own default.
+        throughput, ratio -- the target for 'auto'. See above.
+        sample_size -- how much of the pickle 'auto' tries the codecs on.
+        parallel -- if not zero, the number of processes that compress
+            the pickle in blocks. The codec must be bz2. read() always
+            decompresses parallel files in parallel.
+        block_size -- the size of the blocks, before compression.
         """
 
+        if codec not in ('auto', 'mapped') and codec not in codecs:
+            raise Exception(f"unknown codec {codec}. must be one of {tuple(codecs)}, 'auto', or 'mapped'.")
+        if codec in codecs:
+            level = default_levels[codec] if level is None else level
+            if level not in levels[codec]:
+                raise Exception(f"{codec} level must be in {levels[codec]}.")
+        if parallel and codec != 'bz2':
+            raise Exception("parallel compression is only for bz2.")
+
         self.encoding = encoding
         self.unit = None
         self.name = None
         self.verbose = verbose
+        self.codec = codec
+        self.level = level
+        self.throughput = throughput
+        self.ratio = ratio
+        self.sample_size = sample_size
+        self.parallel = parallel
+        self.block_size = block_size
+        self.archive = None
+        self.archive_end = 0
         
 
     @trap
@@ -105,22 +597,45 @@ class Packer:
         return False
 
 
+    def sink(self, unit:object, codec:str, level:int) -> CompressingWriter:
+        """
+        Write the header, and return a writer that compresses with codec.
+        """
+        unit.write(header.pack(magic, format_version, codecs[codec], level))
+        return CompressingWriter(unit, compressor_for(codec, level))
+
+
     @trap
     def write(self, o:object, *, show_stats=False) -> bool:
         """
         serialize the argument, and write the serialization to the 
-        current file and close the file.
+        current file and close the file. The pickle is compressed as it
+        is made, so the only extra memory is the compressor's block.
 
         o -- the Python object to be written
 
         returns -- true on success, false otherwise.
         """
+        pool = None
         try:
-            it = pickle.dumps(o) 
-            self.verbose and tombstone(f'output {len(it)} bytes.')
-            it = bz2.compress(it)
-            self.verbose and tombstone(f'BWT reduces to {len(it)} bytes.')
-            
+            if self.codec == 'mapped': return self.write_mapped(o)
+
+            # Protocol 5 hands large buffers (bytes, arrays) to write() 
+            # as they are, rather than copying them into the pickle.
+            if self.parallel:
+                pool = concurrent.futures.ProcessPoolExecutor(self.parallel)
+                sink = BlockWriter(self.unit, pool, self.parallel, self.block_size, self.level)
+            elif self.codec == 'auto':
+                sink = SamplingWriter(self.unit, self)
+            else:
+                sink = self.sink(self.unit, self.codec, self.level)
+            pickle.Pickler(sink, protocol=5).dump(o)
+            sink.close()
+            self.verbose and tombstone(f'output {sink.bytes_in} bytes.')
+            self.verbose and tombstone(f'compression reduces to {sink.bytes_out} bytes.')
+            self.verbose and tombstone(f"{sink.bytes_out} bytes written")
+            return True
+
         except pickle.PicklingError as e:
             tombstone(str(e))
             return False   
@@ -129,23 +644,60 @@ class Packer:
             tombstone(str(e))
             return False
 
-        x = 0
-        try:          
-            x = self.unit.write(it)
-            self.verbose and tombstone(f"{x} bytes written")
+        finally:
+            if pool is not None: pool.shutdown()
+            self.unit.close()
+            self.unit = None
+
+    
+    @trap
+    def write_file(self, source:str, *, chunk:int=1<<20) -> bool:
+        """
+        Write the contents of a file as a bytes object, just as write()
+        would write the result of reading it, so that read() returns 
+        the bytes. The file is streamed through the compressor chunk 
+        bytes at a time, and is never in memory all at once.
+
+        source -- the name of the file.
+
+        returns -- true on success, false otherwise.
+        """
+        pool = None
+        try:
+            if self.codec == 'mapped':
+                raise Exception("write_file cannot write the 'mapped' format.")
+            if self.parallel:
+                pool = concurrent.futures.ProcessPoolExecutor(self.parallel)
+                sink = BlockWriter(self.unit, pool, self.parallel, self.block_size, self.level)
+            elif self.codec == 'auto':
+                sink = SamplingWriter(self.unit, self)
+            else:
+                sink = self.sink(self.unit, self.codec, self.level)
+
+            # The pickle of one bytes object: its length, the bytes, and
+            # the end. This is what protocol 5 writes for large bytes.
+            sink.write(pickle.PROTO + bytes([5]) + 
+                pickle.BINBYTES8 + os.path.getsize(source).to_bytes(8, 'little'))
+            with open(source, 'rb') as f:
+                while data := f.read(chunk):
+                    sink.write(data)
+            sink.write(pickle.STOP)
+            sink.close()
+            self.verbose and tombstone(f"{sink.bytes_in} bytes in, {sink.bytes_out} bytes written")
             return True
 
         except Exception as e:
             tombstone(str(e))
-            return False   
+            return False
 
         finally:
+            if pool is not None: pool.shutdown()
             self.unit.close()
             self.unit = None
 
     
     @trap
-    def read(self, format:str='python') -> object:
+    def read(self, format:str='python', *, key:object=None) -> object:
         """
         Read and unpack the info in the object in the unit.
 
@@ -155,6 +707,9 @@ class Packer:
             you know is was a pandas.DataFrame when you wrote 
             it, then this is the parameter you want to use.
 
+        key -- for an archive, the key of the record to read. The unit
+            stays open for the next one.
+
         returns -- the decoded contents or None. Raises an
             Exception on an unsupported data format. 
         """
@@ -163,37 +718,278 @@ class Packer:
             tombstone('No unit attached.')
             return None
 
-        self.unit.seek(0, 0)
-        as_read_data = self.unit.read()
-        data = ""
+        if key is not None or self.is_archive():
+            return self.read_record(key, format)
 
+        stream = None
         try:
-            data = bz2.decompress(as_read_data)
+            self.unit.seek(0, 0)
+            if self.unit.read(len(mapped_magic)) == mapped_magic:
+                return self.read_mapped(format)
+
+            what, stream = self.open_stream()
+            self.verbose and tombstone(f"{self.unit.name} is {what}")
+            return self.as_format(pickle.Unpickler(stream).load(), format)
+
+        except EOFError as e:
+            tombstone(f"{self.unit.name} is truncated: {e}")
+
+        except (OSError, lzma.LZMAError, zlib.error) as e:
+            tombstone(f"{self.unit.name} is not valid compressed data: {e}")
+
+        except pickle.UnpicklingError as e:
+            tombstone(f"{self.unit.name} does not hold a valid pickle: {e}")
 
         except Exception as e:
-            # It was not zipped. We can let that one go.
-            pass
+            tombstone(f"cannot read {self.unit.name}: {str(e)}")
 
-        try:
-            pyobj = pickle.loads(data)
-            if format == 'python': 
+        finally:
+            if stream is not None and stream is not self.unit: stream.close()
+            self.unit.close()
+            self.unit = None
+            
+        return None
+
+
+    def open_stream(self) -> Tuple[str, object]:
+        """
+        Look at the first bytes of the unit to find out what it holds,
+        and open a file object that decompresses it as it is read.
+
+        returns -- a description, and the stream of the pickle.
+        """
+        self.unit.seek(0, 0)
+        lead = self.unit.read(max(header.size, 8))
+        self.unit.seek(0, 0)
+
+        if lead[:len(magic)] == magic:
+            _, version, codec, level = header.unpack_from(lead)
+            if version > format_version or codec not in codec_names:
+                raise Exception(f"it is gpacker format {version}, codec {codec}, "
+                    "which this version cannot read.")
+            self.unit.seek(header.size)
+            return f"gpacker format {version}, {codec_names[codec]}", open_codec(codec_names[codec], self.unit)
+
+        if lead[:3] == b'BZh':
+            index = find_block_index(self.unit)
+            self.unit.seek(0, 0)
+            if index:
+                processes = min(self.parallel or os.cpu_count(), len(index))
+                return f"parallel bz2 in {len(index)} blocks", io.BufferedReader(
+                    BlockReader(parallel_blocks(self.unit.name, index, processes)))
+            return "bz2", open_codec('bz2', self.unit)
+
+        for what, signature in sniffers.items():
+            if signature(lead): return what, open_codec(what, self.unit)
+
+        # Protocol 0 and 1 pickles have no signature; anything else that
+        # is not one will fail to unpickle, and read() will say so.
+        return "unrecognized, so read as a plain pickle", self.unit
+
+
+    def as_format(self, pyobj:object, format:str) -> object:
+        if format == 'python': 
+            return pyobj
+
+        elif format == 'pandas': 
+            if have_pandas:
+                return pandas.DataFrame.from_dict(pyobj)
+            else:
+                tombstone("Pandas is not installed")
                 return pyobj
 
-            elif format == 'pandas': 
-                if have_pandas:
-                    return pandas.DataFrame.from_dict(pyobj)
+        else:
+            raise Exception(f'unsupported data format {format}')
+
+
+    ###
+    # Mapped files.
+    ###
+
+    def write_mapped(self, o:object) -> bool:
+        """
+        Write the pickle with its large buffers out of band, each on a
+        page boundary. Buffers smaller than mapped_threshold, and those
+        that are not contiguous, stay in the pickle.
+        """
+        unit = self.unit
+        unit.write(header.pack(mapped_magic, format_version, 0, 0))
+        buffers = []
+
+        def out_of_band(buffer:pickle.PickleBuffer) -> bool:
+            try:
+                view = buffer.raw()
+            except BufferError as e:
+                # Not contiguous; it stays in the pickle.
+                return True
+            if view.nbytes < Packer.mapped_threshold: return True
+            offset = -unit.tell() % mmap.PAGESIZE + unit.tell()
+            unit.write(bytes(offset - unit.tell()))
+            unit.write(view)
+            buffers.append((offset, view.nbytes))
+            return False
+
+        the_pickle = io.BytesIO()
+        pickle.Pickler(the_pickle, protocol=5, buffer_callback=out_of_band).dump(o)
+        offset = unit.tell()
+        unit.write(the_pickle.getbuffer())
+        for b in buffers: unit.write(mapped_buffer.pack(*b))
+        unit.write(mapped_trailer.pack(offset, the_pickle.tell(), len(buffers), mapped_trailer_magic))
+        self.verbose and tombstone(f"{len(buffers)} buffers mapped, and a pickle "
+            f"of {the_pickle.tell()} bytes; {unit.tell()} bytes written")
+        return True
+
+
+    def read_mapped(self, format:str) -> object:
+        """
+        Map the file, and rebuild the object over it. The map stays open
+        as long as any of the arrays made from it are alive.
+        """
+        the_map = mmap.mmap(self.unit.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(the_map)
+        offset, length, count, trailer_magic = mapped_trailer.unpack_from(
+            view, len(view) - mapped_trailer.size)
+        if trailer_magic != mapped_trailer_magic:
+            raise Exception(f"{self.unit.name} is a mapped file that was not completely written.")
+
+        buffers = []
+        for i in range(count):
+            b_offset, b_length = mapped_buffer.unpack_from(view, 
+                offset + length + i * mapped_buffer.size)
+            buffers.append(view[b_offset:b_offset+b_length])
+        return self.as_format(pickle.loads(view[offset:offset+length], buffers=buffers), format)
+
+
+    ###
+    # Archives of many records.
+    ###
+
+    def is_archive(self) -> bool:
+        """
+        Does the attached unit hold an archive? 
+        """
+        if self.archive is not None: return True
+        if 'r' not in self.unit.mode: return False
+        self.unit.seek(0, 0)
+        return self.unit.read(len(archive_magic)) == archive_magic
+
+
+    def load_index(self, unit:object) -> dict:
+        """
+        Read the header and the index of an archive, leaving the codec
+        in self.codec and the end of the last record in self.archive_end.
+
+        returns -- the index: { key : (offset, length) }
+        """
+        unit.seek(0, 0)
+        _, version, codec, level = header.unpack(unit.read(header.size))
+        if version > format_version or codec not in codec_names:
+            raise Exception(f"{unit.name} is gpacker archive format {version}, "
+                f"codec {codec}, which this version cannot read.")
+        self.codec, self.level = codec_names[codec], level
+
+        unit.seek(-archive_trailer.size, os.SEEK_END)
+        offset, length, trailer_magic = archive_trailer.unpack(unit.read(archive_trailer.size))
+        if trailer_magic != archive_trailer_magic:
+            raise Exception(f"{unit.name} is an archive with no index. It was not closed.")
+        unit.seek(offset)
+        self.archive_end = offset
+        return pickle.loads(zlib.decompress(unit.read(length)))
+
+
+    @trap
+    def add(self, key:object, o:object) -> bool:
+        """
+        Add a record to an archive opened with 'create', 'write', or
+        'append'. A key that is already there now means the new record.
+
+        returns -- true on success, false otherwise.
+        """
+        if self.unit is None:
+            tombstone('No unit attached.')
+            return False
+        if self.codec == 'auto' or self.parallel:
+            tombstone("records are compressed with one fixed codec, not auto or parallel.")
+            return False
+
+        try:
+            if self.archive is None:
+                size = os.fstat(self.unit.fileno()).st_size
+                if 'a' in self.unit.mode and size:
+                    # Take the index off the end; it is written again on close.
+                    with open(self.unit.name, 'rb') as f:
+                        self.archive = self.load_index(f)
+                    self.unit.truncate(self.archive_end)
+                    self.unit.seek(self.archive_end)
                 else:
-                    tombstone("Pandas is not installed")
-                    return pyobj
+                    self.archive = {}
+                    self.unit.write(header.pack(archive_magic, format_version, 
+                        codecs[self.codec], self.level))
+
+            start = self.unit.tell()
+            sink = CompressingWriter(self.unit, compressor_for(self.codec, self.level))
+            pickle.Pickler(sink, protocol=5).dump(o)
+            sink.close()
+            self.archive[key] = (start, self.unit.tell() - start)
+            self.verbose and tombstone(f"record {key}: {sink.bytes_in} bytes, {sink.bytes_out} compressed.")
+            return True
 
-            else:
-                raise Exception('unsupported data format {format}')
+        except Exception as e:
+            tombstone(str(e))
+            return False
+
+
+    def read_record(self, key:object, format:str='python') -> object:
+        """
+        Seek to one record of an archive, and decompress only that.
+        """
+        try:
+            if self.archive is None: self.archive = self.load_index(self.unit)
+            offset, length = self.archive[key]
+
+        except KeyError as e:
+            tombstone(f"{self.unit.name} is an archive; read one record with read(key=...)"
+                if key is None else f"no record {key} in {self.unit.name}")
+            return None
 
         except Exception as e:
-            tombstone(f"Unknown error: {str(e)}")
+            tombstone(str(e))
+            return None
+
+        self.unit.seek(offset)
+        return self.as_format(pickle.loads(decompress(self.codec, self.unit.read(length))), format)
+
+
+    def keys(self) -> List[object]:
+        if self.archive is None: self.archive = self.load_index(self.unit)
+        return list(self.archive)
 
+
+    def __getitem__(self, key:object) -> object:
+        return self.read_record(key)
+
+
+    def __iter__(self) -> Iterator[Tuple[object, object]]:
+        """
+        The records of an archive, one at a time, in the order they 
+        were added.
+        """
+        for key in self.keys():
+            yield key, self.read_record(key)
+
+
+    def close(self) -> None:
+        """
+        Close the unit. For an archive being written, write the index.
+        """
+        if self.unit is None: return
+        try:
+            if self.archive is not None and 'r' not in self.unit.mode:
+                index = zlib.compress(pickle.dumps(self.archive, protocol=5))
+                offset = self.unit.tell()
+                self.unit.write(index)
+                self.unit.write(archive_trailer.pack(offset, len(index), archive_trailer_magic))
         finally:
             self.unit.close()
             self.unit = None
-            
-        return data if len(data) else as_read_data
+            self.archive = None
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput and latency of FIFO, compared with the other ways two local
+processes can talk.
+
+Each run starts some writer processes that send count messages of a
+given size, as fast as they can or at a fixed rate, to one reader in
+this process. Every message carries the time it was sent (the monotonic
+clock is the same for every process on the machine), so the reader
+knows the latency of each one. The transports are:
+
+    fifo    -- fifo.FIFO with binary, length framed messages. With more
+        than one writer, a message and its header must fit in PIPE_BUF,
+        or the writers' messages would be torn and interleaved.
+    shm     -- fifo.FIFO with transport='shm': a shared memory ring, and
+        the pipe as a doorbell. There can be only one writer.
+    unix    -- a Unix domain stream socket per writer.
+    mp_pipe -- a multiprocessing.Pipe per writer.
+
+Usage:
+
+    python ipcbench.py --sizes 64 4096 --writers 1 4 --output now.json
+    python ipcbench.py --baseline then.json --output now.json
+
+or from Python:
+
+    from ipcbench import benchmark
+    result = benchmark('fifo', size=1024, count=10000, writers=2)
+
+The results are JSON, one object per run with the same keys in the same
+order every time, so that the files from two releases can be diffed,
+or compared with --baseline.
+"""
+
+import typing
+from   typing import *
+
+import argparse
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import platform
+import select
+import selectors
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from   fifo import FIFO
+from   tombstone import tombstone
+
+# Credits
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2020'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'me@georgeflanagin.com'
+__status__ = 'Prototype'
+
+__license__ = 'MIT'
+
+
+transports = ( 'fifo', 'shm', 'unix', 'mp_pipe' )
+
+# Every message begins with the time it was sent, in nanoseconds.
+stamp = struct.Struct('>Q')
+
+
+def message(size:int) -> bytes:
+    return stamp.pack(time.monotonic_ns()) + bytes(size - stamp.size)
+
+
+def pace(start:float, i:int, rate:float) -> None:
+    """
+    Sleep until it is time to send message i, if there is a rate.
+    """
+    if rate:
+        delay = start + i / rate - time.monotonic()
+        if delay > 0: time.sleep(delay)
+
+
+###
+# The writers, each in its own process.
+###
+
+def fifo_writer(endpoint:str, size:int, count:int, rate:float, transport:str) -> None:
+    pipe = FIFO(endpoint, 'w', binary=True, queue_size=1024, policy='block',
+        transport='shm' if transport == 'shm' else 'pipe')
+    start = time.monotonic()
+    for i in range(count):
+        pace(start, i, rate)
+        # A full ring refuses the write; a full pipe queues it.
+        while not pipe.write([message(size)]): time.sleep(0.00001)
+    pipe.close()
+
+
+def unix_writer(endpoint:str, size:int, count:int, rate:float, transport:str) -> None:
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(endpoint)
+    start = time.monotonic()
+    for i in range(count):
+        pace(start, i, rate)
+        s.sendall(struct.pack('>I', size) + message(size))
+    s.close()
+
+
+def mp_pipe_writer(endpoint:object, size:int, count:int, rate:float, transport:str) -> None:
+    start = time.monotonic()
+    for i in range(count):
+        pace(start, i, rate)
+        endpoint.send_bytes(message(size))
+    endpoint.close()
+
+
+###
+# The readers. Each returns a function that waits up to some number of
+# seconds and returns the messages that arrived, the endpoints for the
+# writers, and a function to clean up.
+###
+
+def fifo_reader(directory:str, writers:int, transport:str) -> Tuple[Callable, list, Callable]:
+    name = os.path.join(directory, 'bench.pipe')
+    pipe = FIFO(name, 'non_block', binary=True, pipe_size=1<<20,
+        transport='shm' if transport == 'shm' else 'pipe')
+    return pipe, [name] * writers, pipe.close
+
+
+def unix_reader(directory:str, writers:int, transport:str) -> Tuple[Callable, list, Callable]:
+    name = os.path.join(directory, 'bench.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(name)
+    listener.listen(writers)
+    selector = selectors.DefaultSelector()
+    buffers = {}
+
+    def accept(s:socket.socket) -> None:
+        conn, address = s.accept()
+        conn.setblocking(False)
+        buffers[conn] = bytearray()
+        selector.register(conn, selectors.EVENT_READ)
+
+    selector.register(listener, selectors.EVENT_READ)
+
+    def read(how_long:float) -> List[bytes]:
+        messages = []
+        for key, event in selector.select(how_long):
+            s = key.fileobj
+            if s is listener:
+                accept(s)
+                continue
+            chunk = s.recv(1<<20)
+            if not chunk:
+                selector.unregister(s)
+                s.close()
+                continue
+            b = buffers[s]
+            b += chunk
+            start = 0
+            while len(b) - start >= 4:
+                size, = struct.unpack_from('>I', b, start)
+                if len(b) - start - 4 < size: break
+                messages.append(bytes(b[start+4:start+4+size]))
+                start += 4 + size
+            del b[:start]
+        return messages
+
+    def close() -> None:
+        selector.close()
+        listener.close()
+
+    return read, [name] * writers, close
+
+
+def mp_pipe_reader(directory:str, writers:int, transport:str) -> Tuple[Callable, list, Callable]:
+    pipes = [ multiprocessing.Pipe(duplex=False) for i in range(writers) ]
+    readers = [ r for r, w in pipes ]
+
+    def read(how_long:float) -> List[bytes]:
+        messages = []
+        for conn in multiprocessing.connection.wait(readers, how_long):
+            try:
+                while True:
+                    messages.append(conn.recv_bytes())
+                    if not conn.poll(): break
+            except EOFError as e:
+                readers.remove(conn)
+        return messages
+
+    def close() -> None:
+        for r, w in pipes:
+            r.close()
+            w.close()
+
+    return read, [ w for r, w in pipes ], close
+
+
+reader_for = { 'fifo': fifo_reader, 'shm': fifo_reader,
+    'unix': unix_reader, 'mp_pipe': mp_pipe_reader }
+
+writer_for = { 'fifo': fifo_writer, 'shm': fifo_writer,
+    'unix': unix_writer, 'mp_pipe': mp_pipe_writer }
+
+
+###
+# Running and reporting.
+###
+
+def percentile(ordered:List[float], p:float) -> float:
+    return ordered[min(len(ordered)-1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+
+def benchmark(transport:str, *,
+    size:int=1024,
+    count:int=10000,
+    writers:int=1,
+    rate:float=0,
+    timeout:float=60) -> dict:
+    """
+    Run one benchmark.
+
+    transport -- one of the transports above.
+    size      -- the bytes in each message, at least 8.
+    count     -- the messages sent by each writer.
+    writers   -- the number of writer processes.
+    rate      -- messages per second from each writer; 0 is flat out.
+    timeout   -- give up on messages that have not arrived by now.
+
+    returns -- a dict of the settings and the results. Latencies are
+        in microseconds.
+    """
+    if transport not in transports:
+        raise Exception(f"unknown transport {transport}. must be one of {transports}.")
+    if transport == 'shm' and writers > 1:
+        raise Exception("the shared memory ring has room for only one writer.")
+    if transport == 'fifo' and writers > 1 and size + 4 > select.PIPE_BUF:
+        raise Exception(f"{size} byte messages from {writers} writers would be torn.")
+    if size < stamp.size:
+        raise Exception(f"messages must be at least {stamp.size} bytes.")
+
+    context = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory() as directory:
+        read, endpoints, close = reader_for[transport](directory, writers, transport)
+        processes = [ context.Process(target=writer_for[transport],
+            args=(endpoint, size, count, rate, transport)) for endpoint in endpoints ]
+
+        start = time.monotonic()
+        for p in processes: p.start()
+        # The parent's copies of the writers' ends must be closed, or
+        # the reader would never see them go away.
+        if transport == 'mp_pipe':
+            for e in endpoints: e.close()
+
+        expected = count * writers
+        latencies = []
+        received = 0
+        deadline = start + timeout
+        while received < expected and time.monotonic() < deadline:
+            messages = read(min(1.0, deadline - time.monotonic()))
+            now = time.monotonic_ns()
+            received += len(messages)
+            latencies.extend( (now - stamp.unpack_from(m)[0]) / 1000 for m in messages )
+        elapsed = time.monotonic() - start
+
+        for p in processes: p.join(timeout)
+        close()
+
+    latencies.sort()
+    return { 'transport': transport, 'size': size, 'writers': writers,
+        'count': count, 'rate': rate, 'received': received,
+        'lost': expected - received, 'seconds': round(elapsed, 6),
+        'msgs_per_s': round(received / elapsed, 1),
+        'MB_per_s': round(received * size / elapsed / 1e6, 3),
+        'p50_us': round(percentile(latencies, 50), 1),
+        'p90_us': round(percentile(latencies, 90), 1),
+        'p99_us': round(percentile(latencies, 99), 1),
+        'p999_us': round(percentile(latencies, 99.9), 1),
+        'max_us': round(latencies[-1] if latencies else 0.0, 1) }
+
+
+def environment() -> dict:
+    """
+    What is needed to know whether two result files are comparable.
+    """
+    import fifo
+    return { 'python': platform.python_version(), 'platform': platform.platform(),
+        'cpus': os.cpu_count(), 'fifo_version': fifo.__version__,
+        'when': time.strftime('%Y-%m-%dT%H:%M:%S') }
+
+
+def compare(baseline:dict, current:dict) -> List[dict]:
+    """
+    Match the runs in two result files, and report the ratio of
+    throughput and of p99 latency (current / baseline).
+    """
+    def key(r:dict) -> tuple:
+        return (r['transport'], r['size'], r['writers'], r['count'], r['rate'])
+
+    before = { key(r): r for r in baseline['results'] }
+    comparisons = []
+    for r in current['results']:
+        b = before.get(key(r))
+        if b is None: continue
+        comparisons.append(dict(zip(('transport', 'size', 'writers', 'count', 'rate'), key(r)),
+            msgs_per_s=round(r['msgs_per_s'] / b['msgs_per_s'], 3) if b['msgs_per_s'] else None,
+            p99_us=round(r['p99_us'] / b['p99_us'], 3) if b['p99_us'] else None))
+    return comparisons
+
+
+def ipcbench_main(myargs:argparse.Namespace) -> int:
+    results = []
+    for transport in myargs.transports:
+        for size in myargs.sizes:
+            for n in myargs.writers:
+                try:
+                    r = benchmark(transport, size=size, count=myargs.count,
+                        writers=n, rate=myargs.rate, timeout=myargs.timeout)
+                except Exception as e:
+                    tombstone(f"skipping {transport}: {e}")
+                    continue
+                sys.stderr.write(f"{transport:>8} {size:>8} B x{n:<3} "
+                    f"{r['msgs_per_s']:>12,.0f} msg/s {r['MB_per_s']:>10,.1f} MB/s "
+                    f"p50 {r['p50_us']:>9,.1f} us  p99 {r['p99_us']:>9,.1f} us\n")
+                results.append(r)
+
+    report = { 'environment': environment(), 'results': results }
+    if myargs.baseline:
+        with open(myargs.baseline) as f:
+            report['comparison'] = compare(json.load(f), report)
+        for c in report['comparison']:
+            sys.stderr.write(f"{c['transport']:>8} {c['size']:>8} B x{c['writers']:<3} "
+                f"throughput x{c['msgs_per_s']}  p99 x{c['p99_us']}\n")
+
+    text = json.dumps(report, indent=2)
+    if myargs.output:
+        with open(myargs.output, 'w') as f: f.write(text + '\n')
+    else:
+        print(text)
+    return os.EX_OK
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='ipcbench',
+        description='Throughput and latency of local IPC transports.')
+    parser.add_argument('--transports', nargs='+', choices=transports, default=list(transports))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[64, 1024, 65536],
+        help='message sizes in bytes')
+    parser.add_argument('--writers', nargs='+', type=int, default=[1, 4],
+        help='numbers of writer processes')
+    parser.add_argument('--count', type=int, default=10000,
+        help='messages sent by each writer')
+    parser.add_argument('--rate', type=float, default=0,
+        help='messages per second from each writer; 0 is flat out')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--baseline', type=str, default='',
+        help='an earlier result file to compare with')
+    parser.add_argument('--output', type=str, default='',
+        help='where to write the JSON; the default is stdout')
+
+    myargs = parser.parse_args()
+    sys.exit(ipcbench_main(myargs))
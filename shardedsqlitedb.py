@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+A logical table spread across several SQLite database files.
+
+Each shard is an ordinary SQLite file with the same schema, and each
+has its own writer thread and connection, so writes to different shards
+proceed in parallel and no one file's write lock, size, or VACUUM time
+governs the whole table. Rows are placed by a key, either by hash or
+by range. SELECTs fan out to every shard on a process pool, and the
+results are merged.
+
+Usage:
+
+    from shardedsqlitedb import ShardedSQLiteDB
+
+    db = ShardedSQLiteDB([f'part{i}.db' for i in range(8)])
+    db.execute('CREATE TABLE IF NOT EXISTS t (id INTEGER, v REAL)')
+    db.insert_many('INSERT INTO t VALUES (?, ?)', rows, key_index=0)
+    db.execute('UPDATE t SET v = ? WHERE id = ?', 1.0, 42, key=42)
+    rows = db.select('SELECT * FROM t WHERE v > ? ORDER BY id', 0.5, order_by=0)
+    (n, total), = db.select('SELECT COUNT(*), SUM(v) FROM t', aggregates=('count', 'sum'))
+"""
+
+import typing
+from   typing import *
+
+import bisect
+import collections
+import concurrent.futures
+import heapq
+import operator
+import os
+import sqlite3
+import threading
+import zlib
+
+from   sqlitedb import SQLiteDB, StatementRegistry
+from   tombstone import tombstone
+
+# Credits
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2020'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'me@georgeflanagin.com'
+__status__ = 'Prototype'
+
+__license__ = 'MIT'
+
+
+def sum_of(xs:Iterable[object]) -> object:
+    """
+    SUM over the shards. A shard with no rows gives NULL, and like
+    SQLite's own SUM, the result is NULL only if every shard's is.
+    """
+    xs = [ x for x in xs if x is not None ]
+    return sum(xs) if xs else None
+
+
+# How the per-shard results of an aggregate are combined.
+combiners = {
+    'count': sum,
+    'sum': sum_of,
+    'total': lambda xs: sum(x for x in xs if x is not None),
+    'min': lambda xs: min((x for x in xs if x is not None), default=None),
+    'max': lambda xs: max((x for x in xs if x is not None), default=None),
+    'first': lambda xs: next(iter(xs), None)
+    }
+
+
+# Each process in the pool keeps one read-only connection per shard.
+reader_connections = {}
+
+def shard_query(path:str, SQL:str, args:tuple) -> list:
+    """
+    Run in the process pool: one SELECT against one shard.
+    """
+    try:
+        db = reader_connections[path]
+    except KeyError as e:
+        db = reader_connections[path] = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True)
+    return db.execute(SQL, args).fetchall()
+
+
+def stable_hash(key:object) -> int:
+    """
+    Python's hash() of a str changes from one process to the next, so
+    it cannot be used to place rows.
+    """
+    if isinstance(key, int): return key
+    if not isinstance(key, bytes): key = str(key).encode('utf-8')
+    return zlib.crc32(key)
+
+
+class ShardedSQLiteDB:
+    """
+    Hash- or range-partitioned set of SQLiteDB files.
+    """
+
+    def __init__(self, paths:List[str], *,
+        ranges:List[object]=None,
+        processes:int=None,
+        **kwargs):
+        """
+        paths     -- one database file per shard. Missing files are created.
+        ranges    -- if given, the shards are range partitioned: ranges
+            holds the sorted upper bounds (exclusive) of all but the last
+            shard, so there must be one fewer than there are paths.
+            Otherwise, the shards are hash partitioned.
+        processes -- the size of the pool for fan-out queries. The
+            default is one per shard.
+        kwargs    -- passed along to each shard's SQLiteDB.
+        """
+        if ranges is not None and len(ranges) != len(paths) - 1:
+            raise Exception(f"{len(paths)} shards need {len(paths)-1} range bounds.")
+
+        self.paths = [ os.path.abspath(p) for p in paths ]
+        self.ranges = ranges
+        self.statements = StatementRegistry()
+        kwargs['use_pandas'] = False
+        self.kwargs = kwargs
+
+        for path in self.paths:
+            if not os.path.exists(path):
+                open(path, 'a').close()
+                tombstone(f"created new shard {path}")
+
+        # One thread per shard, so that each shard's connection is used
+        # only by the thread that opened it.
+        self.local = threading.local()
+        self.writers = [ concurrent.futures.ThreadPoolExecutor(1,
+            thread_name_prefix=f"shard{i}", initializer=self._open,
+            initargs=(path,)) for i, path in enumerate(self.paths) ]
+        self.pool = concurrent.futures.ProcessPoolExecutor(processes or len(paths))
+
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+    def __enter__(self) -> 'ShardedSQLiteDB':
+        return self
+
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+    def _open(self, path:str) -> None:
+        self.local.db = SQLiteDB(path, **self.kwargs)
+
+
+    def shard_of(self, key:object) -> int:
+        """
+        returns -- the index of the shard that holds key.
+        """
+        if self.ranges is not None:
+            return bisect.bisect_right(self.ranges, key)
+        return stable_hash(key) % len(self.paths)
+
+
+    ###
+    # Writes: run by each shard's own thread.
+    ###
+
+    def _write(self, SQL:str, args:tuple) -> int:
+        db = self.local.db
+        cursor = db.cursor.execute(SQL, args)
+        db.db.commit()
+        return cursor.rowcount
+
+
+    def _write_many(self, SQL:str, rows:list) -> int:
+        db = self.local.db
+        try:
+            cursor = db.cursor.executemany(SQL, rows)
+            db.db.commit()
+        except sqlite3.Error as e:
+            db.db.rollback()
+            raise
+        return cursor.rowcount
+
+
+    def insert_many(self, SQL:str, rows:Iterable[tuple], *,
+        key_index:int=0) -> int:
+        """
+        Route each row to its shard by the value at key_index, and
+        let the shards' writers insert them concurrently, each in one
+        transaction.
+
+        returns -- the number of rows inserted.
+        """
+        by_shard = collections.defaultdict(list)
+        for row in rows:
+            by_shard[self.shard_of(row[key_index])].append(row)
+
+        futures = [ self.writers[i].submit(self._write_many, SQL, part)
+            for i, part in by_shard.items() ]
+        return sum(f.result() for f in futures)
+
+
+    ###
+    # Reads: fanned out to the process pool.
+    ###
+
+    def select(self, SQL:str, *args,
+        key:object=None,
+        order_by:Union[int, Callable, Tuple[int]]=None,
+        reverse:bool=False,
+        aggregates:Tuple[str]=None,
+        limit:int=None) -> list:
+        """
+        Run a SELECT on every shard (or only key's shard), and merge the
+        results.
+
+        order_by   -- if the SQL has an ORDER BY, name the column(s) it
+            sorts on (an index, a tuple of indexes, or a key function)
+            so that the already sorted shard results can be merged in
+            order. Set reverse for DESC.
+        aggregates -- for a query that returns one row per shard, how to
+            combine each column: 'count', 'sum', 'total', 'min', 'max',
+            or 'first'. AVG cannot be combined this way; select SUM and
+            COUNT instead.
+        limit      -- keep only this many merged rows. Each shard should
+            apply the same LIMIT in its SQL.
+
+        returns -- the merged rows. Without order_by or aggregates, the
+            shards' rows are simply concatenated.
+        """
+        if len(args) == 1 and isinstance(args[0], (tuple, list)):
+            args = tuple(args[0])
+
+        paths = self.paths if key is None else [self.paths[self.shard_of(key)]]
+        results = list(self.pool.map(shard_query, paths,
+            [SQL]*len(paths), [args]*len(paths)))
+
+        if aggregates:
+            rows = [ r[0] for r in results if r ]
+            return [ tuple(combiners[a](column)
+                for a, column in zip(aggregates, zip(*rows))) ] if rows else []
+
+        if order_by is not None:
+            if isinstance(order_by, int):
+                order_by = operator.itemgetter(order_by)
+            elif isinstance(order_by, tuple):
+                order_by = operator.itemgetter(*order_by)
+            merged = heapq.merge(*results, key=order_by, reverse=reverse)
+        else:
+            merged = ( row for r in results for row in r )
+
+        if limit is not None:
+            merged = ( row for i, row in zip(range(limit), merged) )
+        return list(merged)
+
+
+    def execute(self, SQL:str, *args, key:object=None) -> Union[list, int]:
+        """
+        Run a statement. A read is the same as select() with no merge
+        options. A write goes to key's shard if key is given, and
+        otherwise to every shard (DDL, or updates without a key).
+
+        returns -- rows for reads, and the number of rows affected for
+            writes.
+        """
+        if len(args) == 1 and isinstance(args[0], (tuple, list)):
+            args = tuple(args[0])
+
+        if self.statements(SQL).is_read:
+            return self.select(SQL, *args, key=key)
+
+        writers = self.writers if key is None else [self.writers[self.shard_of(key)]]
+        futures = [ w.submit(self._write, SQL, args) for w in writers ]
+        return sum(max(f.result(), 0) for f in futures)
+
+
+    def _close(self) -> None:
+        self.local.db.db.close()
+
+
+    def close(self) -> None:
+        for w in self.writers: 
+            w.submit(self._close)
+            w.shutdown()
+        self.pool.shutdown()
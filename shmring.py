@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+A single-producer, single-consumer ring buffer of records in shared
+memory.
+
+Exchanging records through a pipe costs a system call and two copies
+(into the kernel and back out) for every read and write. With the ring,
+the producer copies each record once into memory that the consumer can
+see, and neither side calls the kernel. FIFO uses it when opened with
+transport='shm', and the pipe is then only a doorbell that the producer
+rings when the consumer has gone to sleep.
+
+The layout is a header, then the data area:
+
+    offset   0 -- head: the total bytes ever written (by the producer).
+    offset  64 -- tail: the total bytes ever read (by the consumer).
+    offset 128 -- idle: set by the consumer before it sleeps.
+    offset 192 -- the capacity of the data area.
+
+Each field has a cache line of its own, so that the two processes do
+not contend for one. Each record is a four byte, big-endian length and
+then the bytes, and a record may wrap around the end of the data area.
+The head is only advanced after the records are in place, and the tail
+only after they have been copied out.
+
+Usage:
+
+    ring = ShmRing('myring', 1<<20, create=True)    # the consumer
+    ring = ShmRing('myring')                        # the producer
+
+    ring.put([b'one', b'two'])      # False if there is no room.
+    records = ring.get()            # [b'one', b'two']
+"""
+
+import typing
+from   typing import *
+
+import struct
+import sys
+from   multiprocessing import resource_tracker, shared_memory
+
+# Credits
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2020'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'me@georgeflanagin.com'
+__status__ = 'Prototype'
+
+__license__ = 'MIT'
+
+
+HEAD = 0
+TAIL = 64
+IDLE = 128
+CAPACITY = 192
+DATA = 256
+
+
+class ShmRing:
+    """
+    SPSC ring buffer on multiprocessing.shared_memory.
+    """
+
+    def __init__(self, name:str, size:int=1<<22, *, create:bool=False):
+        """
+        name   -- the name of the shared memory block.
+        size   -- the capacity of the data area, in bytes. Only used
+            when creating the ring.
+        create -- the consumer creates the ring, and removes it when it
+            is done; the producer attaches to it.
+        """
+        self.name = name
+        self.owner = create
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory(name, create=True, size=DATA + size)
+            except FileExistsError as e:
+                # Left over from a consumer that did not clean up. Its
+                # head, tail, and size mean nothing now, so start over.
+                stale = shared_memory.SharedMemory(name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name, create=True, size=DATA + size)
+            struct.pack_into('=Q', self.shm.buf, CAPACITY, size)
+            struct.pack_into('=Q', self.shm.buf, HEAD, 0)
+            struct.pack_into('=Q', self.shm.buf, TAIL, 0)
+            struct.pack_into('=I', self.shm.buf, IDLE, 0)
+        else:
+            self.shm = self.attach(name)
+
+        self.buf = self.shm.buf
+        self.capacity, = struct.unpack_from('=Q', self.buf, CAPACITY)
+        self.data = self.buf[DATA:DATA + self.capacity]
+
+
+    @staticmethod
+    def attach(name:str) -> shared_memory.SharedMemory:
+        """
+        Before Python 3.13, every process that opens a block registers
+        it with the resource tracker, which removes it when the process
+        exits. Only the owner should do that.
+        """
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name, track=False)
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+    def __len__(self) -> int:
+        """
+        The number of bytes waiting to be read.
+        """
+        return self.head - self.tail
+
+
+    def __str__(self) -> str:
+        return f"ring {self.name}: {len(self)} of {self.capacity} bytes in use"
+
+
+    @property
+    def head(self) -> int:
+        return struct.unpack_from('=Q', self.buf, HEAD)[0]
+
+
+    @property
+    def tail(self) -> int:
+        return struct.unpack_from('=Q', self.buf, TAIL)[0]
+
+
+    @property
+    def idle(self) -> bool:
+        return not not struct.unpack_from('=I', self.buf, IDLE)[0]
+
+
+    @idle.setter
+    def idle(self, value:bool) -> None:
+        struct.pack_into('=I', self.buf, IDLE, int(value))
+
+
+    def _copy_in(self, position:int, data:object) -> None:
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.data[start:start+first] = data[:first]
+        if first < len(data): self.data[:len(data)-first] = data[first:]
+
+
+    def _copy_out(self, position:int, n:int) -> bytes:
+        start = position % self.capacity
+        first = min(n, self.capacity - start)
+        if first == n: return bytes(self.data[start:start+n])
+        return bytes(self.data[start:start+first]) + bytes(self.data[:n-first])
+
+
+    def put(self, records:List[object]) -> bool:
+        """
+        Producer: add the records, all or none.
+
+        returns -- False if there is not room for all of them.
+        """
+        views = [ memoryview(_).cast('B') for _ in records ]
+        needed = sum(4 + len(_) for _ in views)
+        if needed > self.capacity:
+            raise Exception(f"{needed} bytes will never fit in {self}")
+
+        head = self.head
+        if needed > self.capacity - (head - self.tail): return False
+
+        for v in views:
+            self._copy_in(head, struct.pack('>I', len(v)))
+            self._copy_in(head + 4, v)
+            head += 4 + len(v)
+
+        # Publish the records only after they are all in place.
+        struct.pack_into('=Q', self.buf, HEAD, head)
+        return True
+
+
+    def get(self, limit:int=None) -> List[bytes]:
+        """
+        Consumer: remove and return the waiting records, at most limit
+        of them.
+        """
+        records = []
+        tail, head = self.tail, self.head
+        while tail < head and (limit is None or len(records) < limit):
+            size, = struct.unpack('>I', self._copy_out(tail, 4))
+            records.append(self._copy_out(tail + 4, size))
+            tail += 4 + size
+
+        struct.pack_into('=Q', self.buf, TAIL, tail)
+        return records
+
+
+    def close(self) -> None:
+        """
+        Detach, and if this side created the ring, remove it.
+        """
+        self.data.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            # A producer forked from this process shares its resource 
+            # tracker, and may have unregistered the block on attaching.
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            try:
+                self.shm.unlink()
+            except FileNotFoundError as e:
+                pass
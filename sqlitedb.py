@@ -20,13 +20,20 @@ __license__ =       'MIT'
 import typing
 from   typing import *
 
+import bz2
 import collections
 import csv
 from   functools import reduce
+import gzip
+import itertools
+import lzma
+import math
 import operator
 import os
+import re
 import sqlite3
 import sys
+import tempfile
 import time
 
 try:
@@ -35,9 +42,746 @@ try:
 except ImportError as e:
     have_pandas = False
 
+try:
+    import numpy
+    have_numpy = True
+except ImportError as e:
+    have_numpy = False
+
 
 from   tombstone import tombstone
 from   gdecorators import trap
+from   gpacker import Packer
+
+###
+# Statement classification.
+###
+
+# Everything we know about a distinct SQL string after looking at it once.
+#
+#   SQL      -- the text, exactly as presented.
+#   verb     -- the statement that actually runs: 'select', 'insert', 
+#       'pragma', etc. For WITH ... it is the verb after the CTEs.
+#   is_read  -- True if the statement returns rows and changes nothing.
+#   tables   -- a frozenset of the (lower case) table names touched.
+#   nparams  -- the number of parameters the statement expects.
+SQLStatement = collections.namedtuple('SQLStatement', 
+    'SQL verb is_read tables nparams')
+
+# Anything not in this set is treated as a write.
+read_verbs = frozenset(('select', 'values', 'explain', 'pragma'))
+
+comment_re = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+literal_re = re.compile(r"'(?:[^']|'')*'")
+word_re = re.compile(r"[a-z_]+|\(|\)")
+param_re = re.compile(r"\?(\d*)|[:@$][a-z_]\w*")
+cte_re = re.compile(r"\b(\w+)\s*(?:\([^)]*\))?\s+as\s*(?:not\s+)?(?:materialized\s*)?\(")
+name_pattern = r"""[\w.$"`\[\]]+"""
+table_res = (
+    re.compile(rf"\b(?:join|into|update)\s+(?:or\s+\w+\s+)?({name_pattern})"),
+    re.compile(rf"\b(?:table|view)\s+(?:if\s+(?:not\s+)?exists\s+)?({name_pattern})"),
+    re.compile(rf"\bindex\s+(?:if\s+not\s+exists\s+)?\S+\s+on\s+({name_pattern})"),
+    )
+from_re = re.compile(r"""\bfrom\s+(.*?)(?=\bwhere\b|\bgroup\b|\border\b|"""
+    r"""\blimit\b|\bjoin\b|\bleft\b|\binner\b|\bcross\b|\bnatural\b|"""
+    r"""\bunion\b|\bexcept\b|\bintersect\b|\bhaving\b|\bwindow\b|"""
+    r"""\breturning\b|\)|;|$)""", re.S)
+
+
+def bare_name(s:str) -> str:
+    """
+    Remove the quoting and the schema prefix from a table name.
+    """
+    s = s.strip('"`[]').lower()
+    return s.split('.')[-1].strip('"`[]')
+
+
+def classify_SQL(SQL:str) -> SQLStatement:
+    """
+    Take a single SQL statement apart just far enough to know
+    how to run it. This is not a parser; it does not need to be.
+
+    SQL -- the statement.
+
+    returns -- an SQLStatement.
+    """
+    text = literal_re.sub("''", comment_re.sub(' ', SQL)).lower()
+    words = word_re.findall(text)
+    first = next((w for w in words if w != '('), '')
+
+    verb = first
+    if first == 'with':
+        # The statement that runs is the first verb found at the 
+        # outer level of parentheses after the common table expressions.
+        depth = 0
+        for w in words[1:]:
+            if w == '(': depth += 1
+            elif w == ')': depth -= 1
+            elif not depth and w in ('select', 'insert', 'update', 'delete', 'replace'):
+                verb = w
+                break
+
+    if verb == 'pragma':
+        is_read = '=' not in text
+    else:
+        is_read = verb in read_verbs
+
+    tables = set()
+    for r in table_res:
+        tables.update(bare_name(t) for t in r.findall(text))
+    for clause in from_re.findall(text):
+        for t in clause.split(','):
+            t = t.split()
+            if t and not t[0].startswith('('): tables.add(bare_name(t[0]))
+    tables -= set(cte_re.findall(text)) if first == 'with' else set()
+    tables.discard('')
+
+    # Numbered (?NNN) and named parameters count once, no matter how
+    # many times they appear; bare ? are positional and always count.
+    positional = 0
+    numbered = set()
+    named = set()
+    for m in param_re.finditer(text):
+        if m.group(0) == '?': positional += 1
+        elif m.group(1): numbered.add(int(m.group(1)))
+        else: named.add(m.group(0)[1:])
+    nparams = positional + len(named) + (max(numbered) if numbered else 0)
+
+    return SQLStatement(SQL, verb, is_read, frozenset(tables), nparams)
+
+
+class StatementRegistry:
+    """
+    Classify each distinct SQL string once, and remember the result.
+    The registry is bounded, and the least recently used statements
+    are forgotten first. For the registry to do its job, it should 
+    be at least as large as the connection's cached_statements so that
+    a hot statement skips both our classification and SQLite's 
+    re-preparation.
+    """
+
+    def __init__(self, size:int=256):
+        self.size = size
+        self.statements = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __call__(self, SQL:str) -> SQLStatement:
+        """
+        Look up (or classify) the statement.
+        """
+        try:
+            stmt = self.statements[SQL]
+            self.statements.move_to_end(SQL)
+            self.hits += 1
+            return stmt
+
+        except KeyError as e:
+            self.misses += 1
+            stmt = self.statements[SQL] = classify_SQL(SQL)
+            if len(self.statements) > self.size:
+                self.statements.popitem(last=False)
+            return stmt
+
+
+    def __contains__(self, SQL:str) -> bool:
+        return SQL in self.statements
+
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+
+    def clear(self) -> None:
+        self.statements.clear()
+        self.hits = self.misses = 0
+
+
+###
+# Profiling.
+###
+
+normalize_res = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r"(?<![\w.])-?\d+(?:\.\d*)?(?:e[-+]?\d+)?\b", re.I), '?'),
+    (re.compile(r"\?\d+|[:@$][A-Za-z_]\w*"), '?'),
+    (re.compile(r"\s+"), ' ')
+    )
+
+def normalize_SQL(SQL:str) -> str:
+    """
+    Reduce a statement to its shape, so that the same statement with
+    different literals or parameters is counted together.
+    """
+    SQL = comment_re.sub(' ', SQL)
+    for r, replacement in normalize_res:
+        SQL = r.sub(replacement, SQL)
+    return SQL.strip().rstrip(';')
+
+
+class LatencyHistogram:
+    """
+    Log-scale histogram of latencies, with four buckets per doubling
+    starting from one microsecond. The memory used is a few dozen
+    ints no matter how many times the statement runs, and the 
+    percentiles are good to within about 20 percent. 
+    """
+    per_doubling = 4
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.n = 0
+        self.total = 0.0
+        self.worst = 0.0
+
+
+    def add(self, seconds:float) -> None:
+        self.buckets[max(0, int(math.log2(max(seconds, 1e-6) * 1e6) * 
+            LatencyHistogram.per_doubling))] += 1
+        self.n += 1
+        self.total += seconds
+        self.worst = max(self.worst, seconds)
+
+
+    def percentile(self, p:float) -> float:
+        """
+        returns -- the upper edge of the bucket holding the p-th 
+            percentile, in seconds.
+        """
+        if not self.n: return 0.0
+        target = self.n * p / 100
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= target: break
+        return min(self.worst, 2 ** ((i+1) / LatencyHistogram.per_doubling) / 1e6)
+
+
+class QueryProfiler:
+    """
+    Per-statement accounting for an SQLiteDB. Statements are grouped
+    by their normalized text. For each one we keep
+
+        calls      -- times it came through execute_SQL.
+        executions -- times SQLite ran it, as seen by the trace callback.
+            This includes statements run directly on the connection.
+        rows       -- rows returned (SELECT) or affected (others).
+        latency    -- a LatencyHistogram of the execute_SQL timings.
+        plan       -- EXPLAIN QUERY PLAN for the slowest call over
+            slow_seconds, if there was one.
+    """
+
+    def __init__(self, slow_seconds:float=0.1):
+        self.slow_seconds = slow_seconds
+        self.stats = collections.defaultdict(lambda: {
+            'calls':0, 'executions':0, 'rows':0, 
+            'latency':LatencyHistogram(), 'plan':None, 'plan_seconds':0.0
+            })
+
+
+    def trace(self, SQL:str) -> None:
+        """
+        Callback for sqlite3.Connection.set_trace_callback.
+        """
+        if SQL.startswith('EXPLAIN QUERY PLAN'): return
+        self.stats[normalize_SQL(SQL)]['executions'] += 1
+
+
+    def record(self, SQL:str, seconds:float, rows:int) -> bool:
+        """
+        Account for one call.
+
+        returns -- True if this call is the slowest one over the
+            threshold so far, and the caller should capture its plan.
+        """
+        s = self.stats[normalize_SQL(SQL)]
+        s['calls'] += 1
+        s['rows'] += max(rows, 0)
+        s['latency'].add(seconds)
+        return seconds >= self.slow_seconds and seconds > s['plan_seconds']
+
+
+    def keep_plan(self, SQL:str, seconds:float, plan:list) -> None:
+        s = self.stats[normalize_SQL(SQL)]
+        s['plan'] = plan
+        s['plan_seconds'] = seconds
+
+
+    def report(self) -> str:
+        """
+        returns -- the statements, most expensive (total time) first, 
+            with times in milliseconds.
+        """
+        lines = [ f"{'total':>10} {'calls':>8} {'execs':>8} {'rows':>10} "
+            f"{'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  statement",
+            "-"*100 ]
+        for SQL, s in sorted(self.stats.items(), 
+                key=lambda kv: kv[1]['latency'].total, reverse=True):
+            h = s['latency']
+            lines.append(f"{h.total*1000:10.2f} {s['calls']:8} {s['executions']:8} "
+                f"{s['rows']:10} {h.percentile(50)*1000:9.3f} "
+                f"{h.percentile(95)*1000:9.3f} {h.percentile(99)*1000:9.3f} "
+                f"{h.worst*1000:9.3f}  {SQL}")
+            if s['plan']:
+                lines.append(f"{'':>10} plan captured at {s['plan_seconds']*1000:.2f} ms:")
+                lines.extend(f"{'':>12} {row[-1]}" for row in s['plan'])
+
+        return "\n".join(lines)
+
+
+###
+# Result caching.
+###
+
+# The authorizer actions that change the contents of a table, and
+# which of the callback's arguments holds the table name.
+write_actions = {
+    sqlite3.SQLITE_INSERT: 0,
+    sqlite3.SQLITE_UPDATE: 0,
+    sqlite3.SQLITE_DELETE: 0,
+    sqlite3.SQLITE_DROP_TABLE: 0,
+    sqlite3.SQLITE_ALTER_TABLE: 1
+    }
+
+
+# Functions whose results change from one call to the next, so that
+# a SELECT that calls them must not be cached. The date and time 
+# functions only do so when they are asked about 'now', which is also
+# what they assume when called without arguments.
+volatile_functions = frozenset(('random', 'randomblob', 'changes', 'total_changes',
+    'last_insert_rowid', 'current_timestamp', 'current_date', 'current_time'))
+clock_functions = frozenset(('date', 'time', 'datetime', 'julianday', 
+    'unixepoch', 'strftime', 'timediff'))
+now_re = re.compile(r"'now'|\b(?:date|time|datetime|julianday|unixepoch)\s*\(\s*\)", re.I)
+
+
+def size_of(rows:object) -> int:
+    """
+    A fair estimate of the memory held by a result set.
+    """
+    if have_pandas and isinstance(rows, pandas.DataFrame):
+        return int(rows.memory_usage(deep=True).sum())
+    return sys.getsizeof(rows) + sum(sys.getsizeof(row) + 
+        sum(sys.getsizeof(v) for v in row) for row in rows)
+
+
+class QueryCache:
+    """
+    A read-through cache of SELECT results keyed on (SQL, parameters),
+    evicting the least recently used results to stay under max_bytes.
+
+    The tables each statement reads or writes are learned from the 
+    sqlite3 authorizer callback, once per distinct SQL string, by 
+    preparing an EXPLAIN of the statement. Because the authorizer sees
+    the real table names (through views and triggers), any write made 
+    through the same SQLiteDB drops exactly the results that depend on
+    the tables it changed. A write whose tables cannot be learned drops
+    everything. The authorizer also names the functions a statement 
+    calls, and a SELECT that calls random(), asks for the time 'now',
+    and the like is never cached. What was learned is remembered for
+    the max_statements most recently used SQL strings.
+    """
+
+    def __init__(self, max_bytes:int=64*1024*1024, max_statements:int=1024):
+        self.max_bytes = max_bytes
+        self.max_statements = max_statements
+        self.nbytes = 0
+        self.results = collections.OrderedDict()
+        self.by_table = collections.defaultdict(set)
+        self.dependencies = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+
+    @property
+    def hit_rate(self) -> float:
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+
+    @property
+    def stats(self) -> dict:
+        return { 'entries': len(self.results), 'bytes': self.nbytes, 
+            'statements': len(self.dependencies),
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate,
+            'invalidations': self.invalidations, 'evictions': self.evictions }
+
+
+    def tables_of(self, db:sqlite3.Connection, SQL:str, args:tuple) -> tuple:
+        """
+        returns -- (tables read, tables written, functions called) by
+            the statement, or None if SQLite will not prepare it.
+        """
+        try:
+            tables = self.dependencies[SQL]
+            self.dependencies.move_to_end(SQL)
+            return tables
+        except KeyError as e:
+            pass
+
+        read, written, functions = set(), set(), set()
+        def authorizer(action, arg1, arg2, dbname, source):
+            if action == sqlite3.SQLITE_READ and arg1: 
+                read.add(arg1.lower())
+            elif action == sqlite3.SQLITE_FUNCTION and arg2:
+                functions.add(arg2.lower())
+            elif action in write_actions:
+                written.add((arg1, arg2)[write_actions[action]].lower())
+            return sqlite3.SQLITE_OK
+
+        db.set_authorizer(authorizer)
+        try:
+            db.execute('EXPLAIN ' + SQL, args).close()
+            tables = self.dependencies[SQL] = (frozenset(read), frozenset(written), 
+                frozenset(functions))
+            if len(self.dependencies) > self.max_statements:
+                self.dependencies.popitem(last=False)
+        except sqlite3.Error as e:
+            tables = None
+        finally:
+            db.set_authorizer(None)
+
+        return tables
+
+
+    @staticmethod
+    def volatile(SQL:str, args:tuple, functions:frozenset) -> bool:
+        """
+        returns -- True if running the statement again might give a
+            different result even though no table has changed.
+        """
+        if functions & volatile_functions: return True
+        if not functions & clock_functions: return False
+        return (now_re.search(SQL) is not None or 
+            any(isinstance(_, str) and _.strip().lower() == 'now' for _ in args))
+
+
+    def get(self, SQL:str, args:tuple) -> object:
+        """
+        returns -- a copy of the cached result, or None.
+        """
+        try:
+            rows, tables, nbytes = self.results[(SQL, args)]
+        except (KeyError, TypeError) as e:
+            self.misses += 1
+            return None
+
+        self.results.move_to_end((SQL, args))
+        self.hits += 1
+        return rows.copy()
+
+
+    def put(self, SQL:str, args:tuple, rows:object, tables:frozenset) -> None:
+        key = (SQL, args)
+        try:
+            hash(key)
+        except TypeError as e:
+            return
+
+        nbytes = size_of(rows)
+        if nbytes > self.max_bytes: return
+
+        self.discard(key)
+        self.results[key] = (rows.copy(), tables, nbytes)
+        self.nbytes += nbytes
+        for t in tables: self.by_table[t].add(key)
+
+        while self.nbytes > self.max_bytes:
+            self.discard(next(iter(self.results)))
+            self.evictions += 1
+
+
+    def discard(self, key:tuple) -> None:
+        try:
+            rows, tables, nbytes = self.results.pop(key)
+        except KeyError as e:
+            return
+
+        self.nbytes -= nbytes
+        for t in tables: self.by_table[t].discard(key)
+
+
+    def invalidate(self, tables:Iterable[str]=None) -> None:
+        """
+        Drop the results that read any of the tables, or everything
+        if tables is None.
+        """
+        if tables is None:
+            self.invalidations += len(self.results)
+            self.results.clear()
+            self.by_table.clear()
+            self.nbytes = 0
+            return
+
+        for t in tables:
+            for key in list(self.by_table.pop(t.lower(), ())):
+                self.discard(key)
+                self.invalidations += 1
+
+
+###
+# Index advice.
+###
+
+alias_re = re.compile(r"\b(?:from|join|update)\s+([\w\"]+)(?:\s+(?:as\s+)?(?!(?:where|join|on|left|inner|cross|natural|order|group|limit|set|using|having|window|union)\b)(\w+))?")
+comparison_re = re.compile(r"(?:(\w+)\.)?(\w+)\s*(==|=|<=|>=|<>|!=|<|>|\bin\b|\bis\b|\blike\b|\bbetween\b|\bglob\b)")
+reversed_comparison_re = re.compile(r"(?:=|==)\s*(?:(\w+)\.)?(\w+)")
+where_re = re.compile(r"\b(?:where|on)\b(.*?)(?=\bgroup\s+by\b|\border\s+by\b|\blimit\b|\bjoin\b|\bleft\b|\binner\b|\bunion\b|\breturning\b|$)", re.S)
+order_re = re.compile(r"\b(?:order|group)\s+by\b(.*?)(?=\blimit\b|\bhaving\b|\border\b|\bwindow\b|\)|$)", re.S)
+scan_re = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+automatic_re = re.compile(r"^SEARCH (\w+) USING AUTOMATIC (?:COVERING |PARTIAL )*INDEX \((.*)\)")
+
+
+class IndexAdvisor:
+    """
+    Watch the statements run through an SQLiteDB, and suggest indexes
+    for the ones whose query plans scan whole tables, build automatic
+    indexes, or sort in temporary B-trees. 
+
+    The candidates can be tried on a scratch copy of the database: each
+    one is built, ANALYZE refreshes sqlite_stat1, and the statements 
+    that motivated it are timed again. The original database is never
+    changed.
+    """
+
+    def __init__(self):
+        # SQL -> [the most recent parameters, number of calls]
+        self.workload = collections.OrderedDict()
+        self.results = []
+
+
+    def record(self, stmt:SQLStatement, args:tuple) -> None:
+        if stmt.verb not in ('select', 'update', 'delete') or not stmt.tables: return
+        try:
+            self.workload[stmt.SQL][0] = args
+            self.workload[stmt.SQL][1] += 1
+        except KeyError as e:
+            self.workload[stmt.SQL] = [args, 1]
+
+
+    def candidates(self, db:sqlite3.Connection) -> Dict[tuple, set]:
+        """
+        returns -- a dict mapping (table, (columns, ...)) to the SQL
+            statements that would benefit.
+        """
+        columns_of = {}
+        def columns(table:str) -> list:
+            if table not in columns_of:
+                columns_of[table] = [ row[1].lower() for row in
+                    db.execute(f'pragma table_info("{table}")') ]
+            return columns_of[table]
+
+        found = collections.defaultdict(set)
+        for SQL, (args, calls) in self.workload.items():
+            try:
+                plan = [ row[-1] for row in db.execute('EXPLAIN QUERY PLAN ' + SQL, args) ]
+            except sqlite3.Error as e:
+                continue
+
+            text = literal_re.sub("''", comment_re.sub(' ', SQL)).lower()
+            aliases = {}
+            for table, alias in alias_re.findall(text):
+                table = bare_name(table)
+                aliases[table] = table
+                if alias: aliases[alias] = table
+            tables = set(aliases.values())
+
+            def owner(prefix:str, column:str) -> str:
+                if prefix: return aliases.get(prefix)
+                owners = [ t for t in tables if column in columns(t) ]
+                return owners[0] if len(owners) == 1 else None
+
+            # Sort out the columns in the WHERE and ON clauses by table.
+            equal = collections.defaultdict(list)
+            ranged = collections.defaultdict(list)
+            for clause in where_re.findall(text):
+                for prefix, column, op in comparison_re.findall(clause):
+                    t = owner(prefix, column)
+                    if t is None or column not in columns(t): continue
+                    target = equal if op in ('=', '==', 'in', 'is') else ranged
+                    if column not in target[t]: target[t].append(column)
+                for prefix, column in reversed_comparison_re.findall(clause):
+                    t = owner(prefix, column)
+                    if t is None or column not in columns(t): continue
+                    if column not in equal[t]: equal[t].append(column)
+
+            ordered = collections.defaultdict(list)
+            for clause in order_re.findall(text):
+                for term in clause.split(','):
+                    term = term.split()
+                    if not term: continue
+                    prefix, _, column = term[0].rpartition('.')
+                    t = owner(prefix, column)
+                    if t is not None and column in columns(t):
+                        ordered[t].append(column)
+
+            for line in plan:
+                m = scan_re.match(line)
+                if m:
+                    t = aliases.get(m.group(1).lower(), m.group(1).lower())
+                    cols = equal[t] + ranged[t][:1]
+                    if cols: found[(t, tuple(cols))].add(SQL)
+                    continue
+
+                m = automatic_re.match(line)
+                if m:
+                    t = aliases.get(m.group(1).lower(), m.group(1).lower())
+                    cols = tuple( c.split('=')[0].split('>')[0].split('<')[0].strip().lower()
+                        for c in m.group(2).split(' AND ') )
+                    found[(t, cols)].add(SQL)
+                    continue
+
+                if line.startswith('USE TEMP B-TREE FOR'):
+                    for t, cols in ordered.items():
+                        found[(t, tuple(equal[t] + [ c for c in cols if c not in equal[t] ]))].add(SQL)
+
+        return found
+
+
+    def timing(self, db:sqlite3.Connection, SQL:str, args:tuple, repeat:int) -> float:
+        """
+        The best of repeat runs. Writes are rolled back.
+        """
+        best = float('inf')
+        for i in range(repeat):
+            start = time.perf_counter()
+            try:
+                cursor = db.execute(SQL, args)
+                cursor.fetchall()
+            finally:
+                if db.in_transaction: db.rollback()
+            best = min(best, time.perf_counter() - start)
+        return best
+
+
+    def advise(self, db:sqlite3.Connection, *,
+        measure:bool=True, 
+        repeat:int=3,
+        scratch:str=None) -> List[dict]:
+        """
+        Find the candidate indexes and, if measure is True, try each
+        one on a scratch copy of the database.
+
+        db      -- the connection to the database being watched.
+        repeat  -- runs of each statement; the best time is kept.
+        scratch -- where to put the copy. A temporary file by default.
+
+        returns -- a list of dicts, fastest speedup first, with the
+            CREATE INDEX statement, the statements it helps, and (if
+            measured) the times before and after and the speedup.
+        """
+        self.results = []
+        found = self.candidates(db)
+        for (table, cols), statements in found.items():
+            name = '_'.join(('ix', 'advisor', table) + cols)
+            self.results.append({ 'index': name,
+                'SQL': f'CREATE INDEX "{name}" ON "{table}" ({", ".join(cols)})',
+                'statements': sorted(statements) })
+
+        if not measure or not self.results: return self.results
+
+        remove = scratch is None
+        if remove:
+            fd, scratch = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+        copy = sqlite3.connect(scratch)
+        try:
+            db.backup(copy)
+            copy.execute('ANALYZE')
+            copy.commit()
+            baseline = { SQL: self.timing(copy, SQL, self.workload[SQL][0], repeat)
+                for SQL in self.workload }
+
+            for result in self.results:
+                copy.execute(result['SQL'])
+                copy.execute('ANALYZE')
+                copy.commit()
+                before = after = 0.0
+                used = False
+                for SQL in result['statements']:
+                    args = self.workload[SQL][0]
+                    plan = copy.execute('EXPLAIN QUERY PLAN ' + SQL, args).fetchall()
+                    used = used or any(result['index'] in row[-1] for row in plan)
+                    before += baseline[SQL]
+                    after += self.timing(copy, SQL, args, repeat)
+                result.update(before=before, after=after, used=used,
+                    speedup=before / after if after else float('inf'))
+                copy.execute(f'DROP INDEX "{result["index"]}"')
+                copy.commit()
+
+        finally:
+            copy.close()
+            if remove: os.unlink(scratch)
+
+        self.results.sort(key=lambda r: r['speedup'], reverse=True)
+        return self.results
+
+
+    def report(self) -> str:
+        """
+        returns -- the results of the last advise(), one per line.
+        """
+        lines = []
+        for r in self.results:
+            if 'speedup' in r:
+                lines.append(f"{r['speedup']:8.1f}x {r['before']*1000:10.3f} ms -> "
+                    f"{r['after']*1000:10.3f} ms {'' if r['used'] else '(unused) '}{r['SQL']}")
+            else:
+                lines.append(r['SQL'])
+            lines.extend(f"{'':>12}{SQL}" for SQL in r['statements'])
+        return "\n".join(lines)
+
+
+###
+# Bulk loading.
+###
+
+# Compressed files are recognized by their extension.
+openers = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+    '.lzma': lzma.open
+    }
+
+
+def open_text(filename:str, encoding:str='utf-8') -> object:
+    """
+    Open a text file for reading, decompressing it on the fly if
+    the extension says that it is compressed.
+    """
+    opener = openers.get(os.path.splitext(filename)[1].lower(), open)
+    return opener(filename, 'rt', encoding=encoding, newline='')
+
+
+def SQL_type_of(values:Iterable[str]) -> str:
+    """
+    Find the narrowest SQLite type that will hold all the (non-empty)
+    values in a column of text.
+    """
+    sql_type = 'INTEGER'
+    for v in values:
+        if not v: continue
+        if sql_type == 'INTEGER':
+            try:
+                int(v)
+                continue
+            except ValueError as e:
+                sql_type = 'REAL'
+        try:
+            float(v)
+        except ValueError as e:
+            return 'TEXT'
+
+    return sql_type
+
 
 class SQLiteDB:
     """
@@ -46,12 +790,30 @@ class SQLiteDB:
     with the name `schema`. This will be used only if the named database
     is not found, or the `force_new_db` parameter to `__init__` is
     True. 
+
+    cached_statements -- the size of sqlite3's prepared statement cache,
+        and of our StatementRegistry. Raise it if your program has 
+        more distinct hot statements than this.
+    mirror -- if True, the database is copied into memory when it is
+        opened, and all the work is done there. Changes are written 
+        back to the file by flush(), by close(), and by the first
+        statement of any kind, read or write, that comes through 
+        execute_SQL flush_interval seconds or more after the last 
+        flush. The connection belongs to this thread, so nothing is 
+        written while the program is idle; call flush() before going
+        quiet for long.
     """
 
     __slots__ = ( 'stmt', 'OK', 'db', 'cursor', 
-        'timeout', 'isolation_level', 'name', 'use_pandas' )
+        'timeout', 'isolation_level', 'name', 'use_pandas',
+        'cached_statements', 'statements', 'profiler', 'result_cache',
+        'advisor', 'mirror', 'flush_interval', 'disk', 'dirty', 
+        'last_flush', 'flushed_changes' )
     __values__ = ( '', False, None, None,
-        15, 'EXCLUSIVE', '', True)
+        15, 'EXCLUSIVE', '', True,
+        256, None, None, None,
+        None, False, 300, None, False,
+        0.0, 0)
     __defaults__ = dict(zip(
         __slots__, __values__
         ))
@@ -76,10 +838,14 @@ class SQLiteDB:
             if k in SQLiteDB.__slots__:
                 setattr(self, k, v)
 
+        self.statements = StatementRegistry(self.cached_statements)
+
         error_on_init = True
         try:
             self.db = sqlite3.connect(self.name, 
-                timeout=self.timeout, isolation_level=self.isolation_level)
+                timeout=self.timeout, isolation_level=self.isolation_level,
+                cached_statements=self.cached_statements)
+            if self.mirror: self.open_mirror()
             self.cursor = self.db.cursor()
             self.keys_on()
             error_on_init = False
@@ -117,6 +883,76 @@ class SQLiteDB:
         return self.db
 
 
+    def open_mirror(self) -> None:
+        """
+        Load the database on disk into memory with the backup API, and 
+        keep the connection to the file for writing it back.
+        """
+        self.disk = self.db
+        self.db = sqlite3.connect(':memory:', 
+            isolation_level=self.isolation_level,
+            cached_statements=self.cached_statements)
+        start = time.time()
+        self.disk.backup(self.db)
+        self.last_flush = time.time()
+        self.flushed_changes = self.db.total_changes
+        self.dirty = False
+        tombstone(f"{self.name} loaded into memory in {self.last_flush-start:.2f} seconds.")
+
+
+    @property
+    def is_dirty(self) -> bool:
+        """
+        Has the mirror changed since it was last written to disk? Writes
+        through execute_SQL set the dirty flag; total_changes catches 
+        the rows changed through the connection directly.
+        """
+        return self.disk is not None and (self.dirty or 
+            self.db.total_changes != self.flushed_changes)
+
+
+    @property
+    def needs_flush(self) -> bool:
+        """
+        Has the mirror changed, and is the last flush flush_interval 
+        seconds or more ago?
+        """
+        return self.is_dirty and time.time() - self.last_flush >= self.flush_interval
+
+
+    def flush(self) -> bool:
+        """
+        Write the in-memory mirror back to the file, if it has changed.
+
+        returns -- True if anything was written.
+        """
+        if not self.is_dirty: return False
+
+        start = time.time()
+        self.db.commit()
+        self.db.backup(self.disk)
+        self.last_flush = time.time()
+        self.flushed_changes = self.db.total_changes
+        self.dirty = False
+        tombstone(f"{self.name} flushed from memory in {self.last_flush-start:.2f} seconds.")
+        return True
+
+
+    def close(self) -> None:
+        """
+        Commit, write back the mirror (if any), and close.
+        """
+        if self.db is None: return
+        self.db.commit()
+        if self.disk is not None:
+            self.flush()
+            self.disk.close()
+            self.disk = None
+        self.db.close()
+        self.db = None
+        self.cursor = None
+
+
     def keys_off(self) -> None:
         self.cursor.execute('pragma foreign_keys = 0')
         self.cursor.execute('pragma synchronous = OFF')
@@ -146,16 +982,68 @@ class SQLiteDB:
         Wrapper that automagically returns rowsets for SELECTs and 
         number of rows affected for other DML statements.
         
-        is_select        -- if we think it is a SELECT statement.
+        stmt             -- what the registry knows about this SQL.
+        is_select        -- if the statement only reads (SELECT, WITH ... 
+            SELECT, EXPLAIN, PRAGMA without an assignment).
         has_args         -- to avoid the problem with the None-tuple.
         self.use_pandas  -- iff True, return a DataFrame on SELECT statements.
 
         """        
-        is_select = SQL.strip().lower().startswith('select')
+        self.stmt = stmt = self.statements(SQL)
+        is_select = stmt.is_read
+
+        # Allow the parameters to be passed as a single tuple, and
+        # discard a None-tuple for statements that take no parameters.
+        if len(args) == 1 and isinstance(args[0], (tuple, list)):
+            args = tuple(args[0])
+        if not stmt.nparams and args in ((), (None,)):
+            args = ()
+
+        if self.advisor is not None: self.advisor.record(stmt, args)
+
+        cache = self.result_cache
+        if cache is not None:
+            if is_select:
+                rval = cache.get(SQL, args)
+                if rval is not None: return rval
+            tables = cache.tables_of(self.db, SQL, args)
+
+        if self.profiler is None:
+            rval = self._execute_SQL(stmt, args)
+
+        else:
+            start = time.perf_counter()
+            rval = self._execute_SQL(stmt, args)
+            elapsed = time.perf_counter() - start
+            if self.profiler.record(SQL, elapsed, 
+                    len(rval) if is_select else rval.rowcount):
+                self.profiler.keep_plan(SQL, elapsed, self.explain(SQL, *args))
+
+        if cache is not None:
+            if tables is None:
+                is_select or cache.invalidate()
+            elif is_select:
+                cache.volatile(SQL, args, tables[2]) or cache.put(SQL, args, rval, tables[0])
+            else:
+                cache.invalidate(tables[1])
+
+        if self.disk is not None:
+            if not is_select: self.dirty = True
+            if self.needs_flush: self.flush()
+
+        return rval
+
+
+    def _execute_SQL(self, stmt:SQLStatement, args:tuple) -> object:
+        """
+        The part of execute_SQL that talks to the database.
+        """
+        SQL = stmt.SQL
+        is_select = stmt.is_read
         has_args = not not args
 
         if self.use_pandas and is_select:
-            return pandas.read_sql_query(SQL, self.db, *args)
+            return pandas.read_sql_query(SQL, self.db, params=args if has_args else None)
         
         if has_args:
             rval = self.cursor.execute(SQL, args)
@@ -167,6 +1055,89 @@ class SQLiteDB:
         return rval
 
 
+    def explain(self, SQL:str, *args) -> list:
+        """
+        returns -- the rows of EXPLAIN QUERY PLAN for the statement, or
+            an empty list if SQLite cannot explain it.
+        """
+        if len(args) == 1 and isinstance(args[0], (tuple, list)):
+            args = tuple(args[0])
+        try:
+            return self.db.cursor().execute('EXPLAIN QUERY PLAN ' + SQL, args).fetchall()
+        except sqlite3.Error as e:
+            return []
+
+
+    def start_caching(self, max_bytes:int=64*1024*1024) -> QueryCache:
+        """
+        Begin caching the results of SELECTs, up to max_bytes of them.
+
+        returns -- the QueryCache, whose stats property has the hit rate.
+        """
+        self.result_cache = QueryCache(max_bytes, self.cached_statements)
+        return self.result_cache
+
+
+    def stop_caching(self) -> QueryCache:
+        """
+        Stop caching, and release the cached results.
+
+        returns -- the QueryCache, for its statistics.
+        """
+        cache, self.result_cache = self.result_cache, None
+        if cache is not None: cache.invalidate()
+        return cache
+
+
+    def start_advising(self) -> IndexAdvisor:
+        """
+        Begin recording the statements for the IndexAdvisor.
+        """
+        self.advisor = IndexAdvisor()
+        return self.advisor
+
+
+    def stop_advising(self, measure:bool=True, **kwargs) -> IndexAdvisor:
+        """
+        Stop recording, work out the candidate indexes, and (if measure
+        is True) time them on a scratch copy. The report is written to
+        stderr.
+
+        returns -- the IndexAdvisor, with its results.
+        """
+        advisor, self.advisor = self.advisor, None
+        if advisor is not None:
+            advisor.advise(self.db, measure=measure, **kwargs)
+            sys.stderr.write(advisor.report() + "\n")
+        return advisor
+
+
+    def start_profiling(self, slow_seconds:float=0.1) -> QueryProfiler:
+        """
+        Begin collecting per-statement statistics. Statements that 
+        take slow_seconds or longer have their query plans captured.
+
+        returns -- the QueryProfiler.
+        """
+        self.profiler = QueryProfiler(slow_seconds)
+        self.db.set_trace_callback(self.profiler.trace)
+        return self.profiler
+
+
+    def stop_profiling(self, report:bool=True) -> QueryProfiler:
+        """
+        Stop collecting statistics, and optionally write the report
+        to stderr.
+
+        returns -- the QueryProfiler, so that it may be examined.
+        """
+        profiler, self.profiler = self.profiler, None
+        self.db.set_trace_callback(None)
+        if report and profiler is not None: 
+            sys.stderr.write(profiler.report() + "\n")
+        return profiler
+
+
 
     def row_one(self, SQL:str, parameters:Union[tuple, None]=None) -> dict:
         """
@@ -177,3 +1148,300 @@ class SQLiteDB:
        
         results = self.execute_SQL(SQL, parameters)
         return None if not results else results[0]
+
+
+    def backup(self, target:str, *,
+        pages:int=256,
+        sleep:float=0.05,
+        progress:Callable=None,
+        archive:bool=False) -> dict:
+        """
+        Copy the live database to target with the sqlite3 backup API,
+        pages at a time, sleeping between the steps so that writers on
+        other connections are barely held up. If another connection 
+        writes during the copy, SQLite starts the copy over; writes made
+        through this object are carried along.
+
+        target   -- name of the copy.
+        pages    -- pages per step. 
+        sleep    -- seconds between steps.
+        progress -- a function called with (pages done, total pages) 
+            after each step. If None, progress is written with tombstone
+            every ten percent.
+        archive  -- if True, the snapshot is compressed into a gpacker
+            archive at target rather than written as a database.
+
+        returns -- a dict with the pages, bytes, seconds, and MB/s.
+        """
+        page_size = self.cursor.execute('pragma page_size').fetchone()[0]
+        reported = [0]
+
+        def step(status:int, remaining:int, total:int) -> None:
+            done = total - remaining
+            if progress is not None:
+                progress(done, total)
+            elif total and done * 10 // total > reported[0]:
+                reported[0] = done * 10 // total
+                tombstone(f"backup of {self.name} {reported[0]*10}% done.")
+            # backup()'s own sleep is only taken when the source is busy
+            # or locked; this is the pause between ordinary steps.
+            if remaining and sleep: time.sleep(sleep)
+
+        copy_name = target
+        if archive:
+            fd, copy_name = tempfile.mkstemp(suffix='.db', 
+                dir=os.path.dirname(os.path.abspath(target)))
+            os.close(fd)
+
+        start = time.time()
+        copy = sqlite3.connect(copy_name)
+        try:
+            self.db.backup(copy, pages=pages, progress=step, sleep=sleep)
+            total = copy.execute('pragma page_count').fetchone()[0]
+        finally:
+            copy.close()
+
+        if archive:
+            try:
+                packer = Packer()
+                if not packer.attachIO(target, 'write') or not packer.write_file(copy_name):
+                    raise Exception(f"could not write archive {target}")
+            finally:
+                os.unlink(copy_name)
+
+        elapsed = time.time() - start
+        stats = { 'pages': total, 'bytes': total * page_size, 'seconds': elapsed,
+            'MB_per_second': total * page_size / elapsed / 2**20 if elapsed else 0.0 }
+        tombstone(f"{self.name} backed up to {target}: {stats['bytes']} bytes in "
+            f"{elapsed:.2f} seconds, {stats['MB_per_second']:.1f} MB/s.")
+        return stats
+
+
+    def fetch_columns(self, SQL:str, *args,
+        dtypes:Union[dict, list]=None,
+        structured:bool=False,
+        chunk:int=65536) -> tuple:
+        """
+        Run a SELECT, and put the results straight into one NumPy
+        array per column, without building a DataFrame or holding all
+        the rows as Python tuples. The rows are fetched chunk at a time
+        into arrays that grow by doubling, and are trimmed at the end.
+
+        dtypes     -- a dict of column name to dtype, or a list of dtypes
+            in column order. Columns without one have their dtype 
+            inferred, and widened if a later chunk requires it.
+        structured -- if True, return one structured array rather
+            than a dict of arrays.
+        chunk      -- rows per fetchmany.
+
+        returns -- (data, nulls). data is a dict of column name to array,
+            or a structured array. nulls is a dict of column name to a
+            boolean mask for each column that had any NULLs; in the
+            data, NULLs are 0 in numeric columns and None in the others.
+        """
+        if not have_numpy: raise Exception('numpy is not installed.')
+        if len(args) == 1 and isinstance(args[0], (tuple, list)):
+            args = tuple(args[0])
+
+        cursor = self.db.cursor()
+        cursor.execute(SQL, args)
+        names = [ d[0] for d in cursor.description ]
+        if isinstance(dtypes, (list, tuple)): dtypes = dict(zip(names, dtypes))
+        declared = { k: numpy.dtype(v) for k, v in (dtypes or {}).items() }
+
+        columns = dict.fromkeys(names)
+        masks = collections.defaultdict(list)
+        n = 0
+        while True:
+            rows = cursor.fetchmany(chunk)
+            if not rows: break
+            size = len(rows)
+
+            for name, values in zip(names, zip(*rows)):
+                dtype = declared.get(name)
+                original = values
+                if None in values:
+                    masks[name].append((n, numpy.fromiter(
+                        (v is None for v in values), bool, size)))
+                    if dtype is None or dtype.kind != 'O':
+                        values = [ 0 if v is None else v for v in values ]
+
+                if dtype is not None:
+                    block = numpy.asarray(values, dtype=dtype)
+                else:
+                    block = numpy.asarray(values)
+                    if block.dtype.kind not in 'biuf': 
+                        block = numpy.asarray(original, dtype=object)
+
+                column = columns[name]
+                if column is None:
+                    column = numpy.empty(max(chunk, size), dtype=block.dtype)
+                elif dtype is None and block.dtype != column.dtype:
+                    widened = numpy.result_type(column.dtype, block.dtype)
+                    if widened.kind not in 'biuf': 
+                        widened = numpy.dtype(object)
+                    column = column.astype(widened)
+                    if widened.kind == 'O':
+                        # The NULLs already stored were 0; now they are None.
+                        for offset, mask in masks.get(name, ()):
+                            if offset < n: column[offset:offset+len(mask)][mask] = None
+
+                # In an object column, a NULL is None, whatever this chunk
+                # alone would have made of it.
+                if column.dtype.kind == 'O' and block.dtype.kind != 'O':
+                    block = numpy.asarray(original, dtype=object)
+                if n + size > len(column):
+                    grown = numpy.empty(max(2 * len(column), n + size), dtype=column.dtype)
+                    grown[:n] = column[:n]
+                    column = grown
+                column[n:n+size] = block
+                columns[name] = column
+
+            n += size
+
+        for name in names:
+            if columns[name] is None:
+                columns[name] = numpy.empty(0, dtype=declared.get(name, numpy.dtype(object)))
+            else:
+                columns[name].resize(n, refcheck=False)
+
+        nulls = {}
+        for name, parts in masks.items():
+            nulls[name] = numpy.zeros(n, dtype=bool)
+            for offset, mask in parts:
+                nulls[name][offset:offset+len(mask)] = mask
+
+        if not structured: return columns, nulls
+
+        data = numpy.empty(n, dtype=[ (name, columns[name].dtype) for name in names ])
+        for name in names: data[name] = columns[name]
+        return data, nulls
+
+
+    def load_CSV(self, filename:str, table:str, *,
+        delimiter:str=None,
+        header:bool=True,
+        sample_size:int=1000,
+        batch_size:int=50000,
+        indexes:Iterable[Union[str, tuple]]=(),
+        empty_as_null:bool=True,
+        encoding:str='utf-8') -> dict:
+        """
+        Stream a CSV or TSV file (optionally compressed with gzip, 
+        bzip2, or xz) into a table. 
+
+        The table is created if it does not exist, with column types
+        inferred from the first sample_size rows. The rows are inserted
+        in batches with executemany, all inside a single transaction,
+        with the foreign keys and synchronous writes turned off. Any 
+        indexes on the table are dropped before the load and built 
+        again after it (or after it fails), along with any new ones 
+        named in indexes.
+
+        filename    -- the file to load.
+        table       -- the name of the table.
+        delimiter   -- if not given, it is a tab for .tsv/.tab files, 
+            and otherwise we let csv.Sniffer have a look.
+        header      -- if True, the first row has the column names. 
+            Otherwise the columns are named c1, c2, ...
+        sample_size -- rows used for type inference.
+        batch_size  -- rows per executemany call.
+        indexes     -- column names, or tuples of column names, to index.
+        empty_as_null -- load empty fields as NULL rather than ''.
+
+        returns -- a dict with the rows loaded, the elapsed seconds, 
+            and the rows per second.
+
+        raises  -- Exception if the file is empty.
+        """
+        start = time.time()
+        table_name = '"' + table.replace('"', '""') + '"'
+        base, ext = os.path.splitext(filename)
+        if ext.lower() in openers: ext = os.path.splitext(base)[1]
+
+        with open_text(filename, encoding) as f:
+            if delimiter is None:
+                if ext.lower() in ('.tsv', '.tab'):
+                    delimiter = '\t'
+                else:
+                    try:
+                        delimiter = csv.Sniffer().sniff(f.read(65536)).delimiter
+                    except csv.Error as e:
+                        delimiter = ','
+                    f.seek(0)
+
+            reader = csv.reader(f, delimiter=delimiter)
+            names = next(reader, None) if header else None
+            sample = list(itertools.islice(reader, sample_size))
+            if not names and not sample: 
+                raise Exception(f"{filename} is empty; there is nothing to load into {table}.")
+            width = len(names) if names else len(sample[0]) if sample else 0
+            if not names: names = [ f"c{i+1}" for i in range(width) ]
+            names = [ '"' + n.strip().replace('"', '""') + '"' for n in names ]
+
+            columns = [ f"{n} {SQL_type_of(row[i] for row in sample if i < len(row))}"
+                for i, n in enumerate(names) ]
+            self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(columns)})")
+
+            # Set aside the existing indexes, and add the new ones.
+            old_indexes = self.cursor.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = ? AND sql IS NOT NULL", (table,)).fetchall()
+            for index_name, _ in old_indexes:
+                self.cursor.execute(f'DROP INDEX "{index_name}"')
+            self.db.commit()
+
+            SQL = f"INSERT INTO {table_name} VALUES ({', '.join('?'*width)})"
+            rows = itertools.chain(sample, reader)
+            if empty_as_null:
+                rows = ( [ v if v != '' else None for v in row ] for row in rows )
+
+            journal_mode = self.cursor.execute('pragma journal_mode').fetchone()[0]
+            self.keys_off()
+            self.cursor.execute('pragma journal_mode = MEMORY')
+            n = 0
+            loaded = False
+            try:
+                while True:
+                    batch = list(itertools.islice(rows, batch_size))
+                    if not batch: break
+                    self.cursor.executemany(SQL, batch)
+                    n += len(batch)
+                self.db.commit()
+                loaded = True
+
+            except Exception as e:
+                self.db.rollback()
+                tombstone(f"load of {filename} abandoned after {n} rows: {e}")
+                raise
+
+            finally:
+                self.cursor.execute(f'pragma journal_mode = {journal_mode}')
+                self.keys_on()
+                # The table is as it was, so its indexes must be, too.
+                if not loaded:
+                    for _, index_SQL in old_indexes:
+                        self.cursor.execute(index_SQL)
+                    self.db.commit()
+
+        load_time = time.time() - start
+        if self.result_cache is not None: self.result_cache.invalidate((table,))
+        for _, index_SQL in old_indexes:
+            self.cursor.execute(index_SQL)
+        for columns in indexes:
+            if isinstance(columns, str): columns = (columns,)
+            index_name = '"' + '_'.join(('ix', table) + tuple(columns)).replace('"', '""') + '"'
+            column_names = ', '.join('"' + c.replace('"', '""') + '"' for c in columns)
+            self.cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} "
+                f"ON {table_name} ({column_names})")
+        self.db.commit()
+
+        elapsed = time.time() - start
+        stats = {
+            'rows': n, 
+            'seconds': elapsed, 
+            'rows_per_second': n / load_time if load_time else 0.0
+            }
+        tombstone(f"{n} rows loaded into {table} in {elapsed:.2f} seconds, "
+            f"{stats['rows_per_second']:.0f} rows per second.")
+        return stats
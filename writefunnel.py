@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+A write funnel: many short-lived processes send their writes through a
+FIFO to one long-lived process that owns the SQLite database.
+
+When dozens of workers write to the same file, they spend their time
+fighting over the EXCLUSIVE lock and retrying on "database is locked."
+With the funnel, only one connection ever writes, and it applies what
+is waiting in batched transactions.
+
+Usage, the daemon:
+
+    from writefunnel import WriteFunnel
+    WriteFunnel('my.db', 'funnel.pipe').run()
+
+Usage, a worker:
+
+    from writefunnel import FunnelClient
+    client = FunnelClient('funnel.pipe')
+    ack = client.send('INSERT INTO t VALUES (?, ?)', 1, 'x')
+    # ack == {'id': 1, 'ok': True, 'rowcount': 1, 'latency': 0.0012}
+
+    for i in range(1000):
+        client.submit('INSERT INTO t VALUES (?, ?)', i, 'y')
+    acks = client.drain()
+    print(client.stats())
+
+Each request is one line of JSON, and must fit in PIPE_BUF bytes so
+that the kernel writes it atomically, no matter how many workers are
+writing at once. Replies come back on a FIFO that belongs to the client.
+"""
+
+import typing
+from   typing import *
+
+import collections
+import json
+import os
+import select
+import time
+
+from   fifo import FIFO
+from   sqlitedb import SQLiteDB
+from   tombstone import tombstone
+
+# Credits
+__author__ = 'George Flanagin'
+__copyright__ = 'Copyright 2020'
+__credits__ = None
+__version__ = '0.1'
+__maintainer__ = 'George Flanagin'
+__email__ = 'me@georgeflanagin.com'
+__status__ = 'Prototype'
+
+__license__ = 'MIT'
+
+
+class WriteFunnel:
+    """
+    The consumer side: one SQLiteDB, fed through one FIFO.
+    """
+
+    def __init__(self, path_to_db:str, pipe_name:str, *,
+        max_batch:int=1000,
+        linger:float=0.005,
+        reply_queue:int=10000,
+        **kwargs):
+        """
+        path_to_db -- the database; it must exist.
+        pipe_name  -- the request FIFO. It is created if need be.
+        max_batch  -- the most requests in one transaction.
+        linger     -- after the first request arrives, how long to wait
+            for others to join it in the same transaction.
+        reply_queue -- the most acknowledgements held for a client that
+            is not reading its replies. Beyond that, the oldest are 
+            dropped, so that one slow client never holds up the rest.
+        kwargs     -- passed along to SQLiteDB.
+        """
+        kwargs['isolation_level'] = None
+        kwargs['use_pandas'] = False
+        self.db = SQLiteDB(path_to_db, **kwargs)
+        if not self.db: raise Exception(f"cannot open {path_to_db}")
+
+        self.requests = FIFO(pipe_name, 'non_block', delimiter='\n', framing='delimiter')
+        # Hold the pipe open for writing ourselves, so that the reader
+        # never sees a hang-up when the last worker goes away.
+        self.keepalive = os.open(self.requests.name, os.O_WRONLY | os.O_NONBLOCK)
+        self.replies = {}
+        self.max_batch = max_batch
+        self.linger = linger
+        self.reply_queue = reply_queue
+        self.running = False
+        self.transactions = 0
+        self.applied = 0
+        self.lost_acks = 0
+
+
+    def reply(self, client:str, acks:List[dict]) -> None:
+        """
+        Queue the acknowledgements for the client, if it is still there,
+        and write what its pipe will take without waiting. The rest go
+        out on later turns of the loop.
+        """
+        if not client: return
+        try:
+            if client not in self.replies:
+                self.replies[client] = FIFO(client, 'w', delimiter='\n', framing='delimiter',
+                    queue_size=self.reply_queue, policy='drop_oldest')
+
+            replies = self.replies[client]
+            drops = replies.drops
+            replies.send([ json.dumps(a) for a in acks ])
+            if replies.drops > drops:
+                self.lost_acks += replies.drops - drops
+                tombstone(f"client {client} is not reading; {replies.drops - drops} acknowledgements dropped.")
+            if replies.hangup: self.forget(client)
+
+        except Exception as e:
+            tombstone(f"client {client} is gone: {e}")
+            self.lost_acks += len(acks)
+            self.replies.pop(client, None)
+
+
+    def flush_replies(self) -> bool:
+        """
+        Write what the clients' pipes will take of the acknowledgements
+        still queued for them.
+
+        returns -- True if some are still waiting.
+        """
+        waiting = False
+        for client, replies in list(self.replies.items()):
+            drops = replies.drops
+            if replies.flush(0): continue
+            self.lost_acks += replies.drops - drops
+            if replies.hangup: 
+                self.forget(client)
+            else:
+                waiting = True
+        return waiting
+
+
+    def forget(self, client:str) -> None:
+        """
+        The client has stopped reading for good; what is still queued
+        for it is lost.
+        """
+        replies = self.replies.pop(client)
+        tombstone(f"client {client} is gone.")
+        self.lost_acks += len(replies.outbound)
+        replies.outbound.clear()
+        replies.close(0)
+
+
+    def apply(self, batch:List[dict]) -> None:
+        """
+        Apply a batch in one transaction. Each request has its own
+        savepoint, so that one bad statement fails alone.
+        """
+        cursor = self.db.cursor
+        acks = []
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for r in batch:
+                cursor.execute('SAVEPOINT request')
+                try:
+                    if r.get('many'):
+                        c = cursor.executemany(r['SQL'], r['args'])
+                    else:
+                        c = cursor.execute(r['SQL'], r['args'])
+                    acks.append({'id': r['id'], 'ok': True, 'rowcount': c.rowcount})
+                    cursor.execute('RELEASE request')
+
+                except Exception as e:
+                    # Not only sqlite3.Error: missing or mistyped args
+                    # raise KeyError, TypeError, or ValueError.
+                    cursor.execute('ROLLBACK TO request')
+                    cursor.execute('RELEASE request')
+                    acks.append({'id': r['id'], 'ok': False, 'error': str(e)})
+
+            cursor.execute('COMMIT')
+            self.transactions += 1
+            self.applied += len(batch)
+
+        except Exception as e:
+            tombstone(f"transaction of {len(batch)} requests failed: {e}")
+            try:
+                if self.db.db.in_transaction: cursor.execute('ROLLBACK')
+            except Exception as e_:
+                tombstone(f"rollback failed: {e_}")
+            acks = [ {'id': r['id'], 'ok': False, 'error': str(e)} for r in batch ]
+
+        by_client = {}
+        for r, a in zip(batch, acks):
+            by_client.setdefault(r.get('reply'), []).append(a)
+        for client, client_acks in by_client.items():
+            self.reply(client, client_acks)
+
+
+    def run(self, how_long:float=None) -> None:
+        """
+        Apply requests until stop() is called, or for how_long seconds.
+        """
+        self.running = True
+        quitting_time = None if how_long is None else time.time() + how_long
+        while self.running and (quitting_time is None or time.time() < quitting_time):
+            # Come back soon for acknowledgements that did not fit.
+            messages = self.requests(0.01 if self.flush_replies() else 1.0)
+            if not messages: continue
+
+            # Give the others a moment to catch up.
+            deadline = time.time() + self.linger
+            while len(messages) < self.max_batch and time.time() < deadline:
+                messages.extend(self.requests(max(deadline - time.time(), 0)))
+
+            batch = []
+            for m in messages:
+                try:
+                    r = json.loads(m)
+                except ValueError as e:
+                    r = None
+                if (isinstance(r, dict) and 'SQL' in r and 'id' in r and 
+                        isinstance(r.get('reply'), (str, type(None)))):
+                    batch.append(r)
+                else:
+                    tombstone(f"discarding malformed request {m[:80]}")
+            for i in range(0, len(batch), self.max_batch):
+                self.apply(batch[i:i+self.max_batch])
+
+
+    def stop(self) -> None:
+        self.running = False
+
+
+class FunnelClient:
+    """
+    The worker side. Each client has its own reply FIFO, named for the
+    process, so acknowledgements go only to the one who asked.
+    """
+
+    # The latency percentiles are over this many of the most recent
+    # acknowledgements.
+    latency_window = 10000
+
+    def __init__(self, pipe_name:str, reply_name:str=None, *, timeout:float=30):
+        """
+        pipe_name  -- the daemon's request FIFO.
+        reply_name -- the FIFO for the acknowledgements. The default is
+            named for the request FIFO and the process.
+        timeout    -- how long a request may wait for room in a full
+            request pipe.
+        """
+        self.timeout = timeout
+        self.requests = FIFO(pipe_name, 'w', delimiter='\n', framing='delimiter')
+        self.reply_name = reply_name or f"{self.requests.name}.{os.getpid()}"
+        self.replies = FIFO(self.reply_name, 'non_block', delimiter='\n', framing='delimiter')
+        self.next_id = 0
+        self.outstanding = {}
+        self.latencies = collections.deque(maxlen=FunnelClient.latency_window)
+        self.acked = 0
+        self.failures = 0
+        self.retries = 0
+
+
+    def __del__(self) -> None:
+        try:
+            os.unlink(self.replies.name)
+        except Exception as e:
+            pass
+
+
+    def _send(self, SQL:str, args:object, many:bool) -> int:
+        self.next_id += 1
+        message = json.dumps({'id': self.next_id, 'reply': self.replies.name,
+            'SQL': SQL, 'args': args, 'many': many})
+        if len(message.encode('utf-8')) + 1 > select.PIPE_BUF:
+            raise Exception(f"request of {len(message)} bytes is larger than PIPE_BUF")
+
+        # The writer is non-blocking; a full pipe means wait for room,
+        # but a pipe with no reader means the daemon is gone. The write
+        # is no larger than PIPE_BUF, so it is all or nothing.
+        payload = self.requests.encode([message])
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                os.write(self.requests.fifo, payload)
+                break
+            except BlockingIOError as e:
+                self.retries += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception(f"request pipe {self.requests.name} was full for {self.timeout} seconds")
+                self.requests.wait_writable(min(1.0, remaining))
+            except BrokenPipeError as e:
+                raise Exception(f"nothing is reading {self.requests.name}; the funnel is gone")
+
+        self.outstanding[self.next_id] = time.perf_counter()
+        return self.next_id
+
+
+    def submit(self, SQL:str, *args) -> int:
+        """
+        Send a statement without waiting for the acknowledgement.
+
+        returns -- the request id.
+        """
+        if len(args) == 1 and isinstance(args[0], (tuple, list)):
+            args = tuple(args[0])
+        return self._send(SQL, args, False)
+
+
+    def submit_many(self, SQL:str, rows:List[tuple]) -> int:
+        """
+        Send an executemany; it must still fit in PIPE_BUF.
+        """
+        return self._send(SQL, rows, True)
+
+
+    def collect(self, timeout:float=0) -> List[dict]:
+        """
+        returns -- whatever acknowledgements have arrived, each with
+            its latency in seconds.
+        """
+        acks = []
+        for m in self.replies(timeout):
+            a = json.loads(m)
+            sent = self.outstanding.pop(a['id'], None)
+            if sent is not None:
+                a['latency'] = time.perf_counter() - sent
+                self.latencies.append(a['latency'])
+                self.acked += 1
+            if not a['ok']: self.failures += 1
+            acks.append(a)
+        return acks
+
+
+    def drain(self, timeout:float=30) -> List[dict]:
+        """
+        Wait for all the outstanding acknowledgements.
+        """
+        acks = []
+        deadline = time.time() + timeout
+        while self.outstanding and time.time() < deadline:
+            acks.extend(self.collect(max(0, min(1.0, deadline - time.time()))))
+        return acks
+
+
+    def send(self, SQL:str, *args, timeout:float=30) -> dict:
+        """
+        Send a statement and wait for its acknowledgement.
+        """
+        request = self.submit(SQL, *args)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for a in self.collect(max(0, min(1.0, deadline - time.time()))):
+                if a['id'] == request: return a
+        raise Exception(f"no acknowledgement of request {request} in {timeout} seconds")
+
+
+    def stats(self) -> dict:
+        """
+        returns -- counts, and latency percentiles in milliseconds over
+            the most recent latency_window acknowledgements.
+        """
+        ordered = sorted(self.latencies)
+        def percentile(p:float) -> float:
+            return 1000 * ordered[min(len(ordered)-1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+        return { 'sent': self.next_id, 'acked': self.acked,
+            'outstanding': len(self.outstanding), 'failures': self.failures,
+            'retries': self.retries, 'p50': percentile(50), 'p95': percentile(95),
+            'p99': percentile(99) }